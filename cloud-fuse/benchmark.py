@@ -0,0 +1,479 @@
+#
+# @file  benchmark.py
+#
+# @brief Benchmarks Context directly, without a kernel mount, against a simulated remote driver.
+#        Results are written as JSON so that runs on different commits can be compared.
+#
+
+from __future__ import print_function, absolute_import, division
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import drivers.deferred
+import drivers.filesystem
+import drivers.replicated
+import drivers.scheduled
+import drivers.simulated
+import drivers.striped
+import helpers.cache
+import helpers.chunking
+import helpers.compression
+import helpers.dentry
+import helpers.transfer
+
+
+#
+# cloud-fuse.py cannot be imported by name. imp, which Python 2 loads it with, is gone from Python 3.12.
+def load_cloud_fuse(path):
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source('cloud_fuse', path)
+
+    spec = importlib.util.spec_from_file_location('cloud_fuse', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['cloud_fuse'] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+
+cloud_fuse = load_cloud_fuse(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cloud-fuse.py'))
+
+
+# Times each call made through it.
+class Recorder:
+    def __init__(self):
+        self.latencies = []
+        self.bytes = 0
+        # Anything else a workload wants to report.
+        self.notes = {}
+
+    def call(self, operation, *args):
+        start = time.time()
+        result = operation(*args)
+        self.latencies.append(time.time() - start)
+
+        return result
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+# (size, seed) -> data, so that generating it is never part of a timed run.
+generated_data = {}
+
+
+def make_data(size, seed):
+    if (size, seed) not in generated_data:
+        generator = random.Random(seed)
+        generated_data[size, seed] = bytes(bytearray(generator.getrandbits(8) for _ in range(size)))
+
+    return generated_data[size, seed]
+
+
+def write_file(context, path, data, io_size, recorder=None):
+    call = recorder.call if recorder else lambda operation, *args: operation(*args)
+
+    fh = call(context.create, path, 0o644)
+    for offset in range(0, len(data), io_size):
+        call(context.write, path, data[offset:offset + io_size], offset, fh)
+    call(context.release, path, fh)
+
+
+def setup_file(context, arguments):
+    write_file(context, '/file', make_data(arguments.file_size, 1), arguments.io_size)
+
+
+def setup_directory(context, arguments):
+    context.mkdir('/directory', 0o755)
+
+    for number in range(arguments.files):
+        write_file(context, '/directory/file{}'.format(number), b"x" * 4096, arguments.io_size)
+
+
+#
+# Fill the database with arguments.nodes files spread over 100 directories, inserted in bulk.
+def setup_nodes(context, arguments):
+    node_table = cloud_fuse.Node.__table__
+    directories = 100
+
+    cloud_fuse.session.execute(node_table.insert(), [dict(id=number + 1, name='directory{}'.format(number),
+                                                          directory=True) for number in range(directories)])
+
+    for batch_start in range(0, arguments.nodes, 10000):
+        cloud_fuse.session.execute(node_table.insert(), [
+            dict(id=directories + number + 1, parent_id=number % directories + 1, name='file{}'.format(number),
+                 directory=False, size=0, block_count=0)
+            for number in range(batch_start, min(batch_start + 10000, arguments.nodes))])
+
+    cloud_fuse.session.commit()
+
+
+#
+# Everything a mount does before it can answer: open the database, start the driver
+# and build the Context, then look up the root and a file.
+def run_startup(context, arguments, recorder):
+    cloud_fuse.session.remove()
+    cloud_fuse.dentry_cache = helpers.dentry.DentryCache()
+
+    recorder.call(cloud_fuse.open_database, 'sqlite:///nodes.db')
+    driver = recorder.call(drivers.deferred.DeferredDriver, lambda: make_driver(arguments),
+                           arguments.driver_concurrency)
+    context = recorder.call(make_context, arguments, driver, 'startup-cache')
+    recorder.call(context.getattr, '/')
+    recorder.call(context.getattr, '/directory0/file0')
+
+    recorder.notes['nodes'] = arguments.nodes
+    recorder.notes['target_seconds'] = arguments.startup_target
+    recorder.notes['met_target'] = sum(recorder.latencies) <= arguments.startup_target
+
+
+def run_sequential_write(context, arguments, recorder):
+    data = make_data(arguments.file_size, 1)
+    write_file(context, '/file', data, arguments.io_size, recorder)
+    recorder.bytes = len(data)
+
+
+def run_sequential_read(context, arguments, recorder):
+    fh = recorder.call(context.open, '/file', 0)
+
+    for offset in range(0, arguments.file_size, arguments.io_size):
+        recorder.bytes += len(recorder.call(context.read, '/file', arguments.io_size, offset, fh))
+
+    recorder.call(context.release, '/file', fh)
+
+
+def run_random_read(context, arguments, recorder):
+    generator = random.Random(2)
+    fh = recorder.call(context.open, '/file', 0)
+
+    for _ in range(arguments.random_operations):
+        offset = generator.randrange(0, max(arguments.file_size - arguments.random_size, 1))
+        recorder.bytes += len(recorder.call(context.read, '/file', arguments.random_size, offset, fh))
+
+    recorder.call(context.release, '/file', fh)
+
+
+def run_random_write(context, arguments, recorder):
+    generator = random.Random(3)
+    data = make_data(arguments.random_size, 4)
+    fh = recorder.call(context.open, '/file', 0)
+
+    for _ in range(arguments.random_operations):
+        offset = generator.randrange(0, max(arguments.file_size - arguments.random_size, 1))
+        recorder.call(context.write, '/file', data, offset, fh)
+        recorder.bytes += len(data)
+
+    recorder.call(context.release, '/file', fh)
+
+
+def run_small_files(context, arguments, recorder):
+    recorder.call(context.mkdir, '/directory', 0o755)
+
+    for number in range(arguments.files):
+        write_file(context, '/directory/file{}'.format(number), b"x" * 4096, arguments.io_size, recorder)
+        recorder.bytes += 4096
+
+
+def run_readdir(context, arguments, recorder):
+    for _ in range(arguments.rounds):
+        recorder.call(context.readdir, '/directory', None)
+
+
+def run_stat(context, arguments, recorder):
+    for _ in range(arguments.rounds):
+        for number in range(arguments.files):
+            recorder.call(context.getattr, '/directory/file{}'.format(number))
+
+
+# Workload name -> (untimed setup, timed run).
+WORKLOADS = [
+    ('sequential_write', (None, run_sequential_write)),
+    ('sequential_read', (setup_file, run_sequential_read)),
+    ('random_read', (setup_file, run_random_read)),
+    ('random_write', (setup_file, run_random_write)),
+    ('small_files', (None, run_small_files)),
+    ('readdir', (setup_directory, run_readdir)),
+    ('stat', (setup_directory, run_stat)),
+    ('startup', (setup_nodes, run_startup)),
+]
+
+
+#
+# One simulated provider, or several striped or replicated together, each with a link of its
+# own. Like a mount, every provider is called through a scheduler.
+def make_driver(arguments):
+    backends = [drivers.scheduled.ScheduledDriver(
+        drivers.simulated.SimulatedDriver(rtt=arguments.rtt / 1000.0,
+                                          bandwidth=arguments.bandwidth * 1024 * 1024 or None,
+                                          jitter=arguments.jitter / 1000.0,
+                                          error_rate=arguments.error_rate,
+                                          concurrency=arguments.driver_concurrency,
+                                          seed=arguments.seed + number,
+                                          slow_rate=arguments.slow_rate,
+                                          slow_delay=arguments.slow_delay / 1000.0,
+                                          rate_limit=arguments.rate_limit or None),
+        rate=arguments.request_rate or None)
+        for number in range(arguments.stripes)]
+
+    if len(backends) == 1:
+        return backends[0]
+
+    if arguments.replicas > 1:
+        return drivers.replicated.ReplicatedDriver(backends, arguments.replicas)
+
+    return drivers.striped.StripedDriver(backends, arguments.placement, locate=cloud_fuse.Block.find_stripe)
+
+
+# Simulated link and scheduler statistics, a list of them when striping, and replica
+# latencies when replicating.
+def get_driver_stats(driver):
+    if isinstance(driver, drivers.striped.StripedDriver):
+        return [get_driver_stats(backend) for backend in driver.backends]
+
+    if isinstance(driver, drivers.replicated.ReplicatedDriver):
+        return dict(driver.stats(), links=[get_driver_stats(backend) for backend in driver.backends])
+
+    return dict(driver.driver.stats(), scheduler=driver.stats())
+
+
+def make_context(arguments, driver, cache_directory, metrics=None, journal_directory=None):
+    block_cache = None
+    if arguments.cache_size > 0:
+        block_cache = helpers.cache.BlockCache(cache_directory, arguments.cache_size * 1024 * 1024)
+
+    chunker = None
+    if arguments.chunking == 'cdc':
+        chunker = helpers.chunking.Chunker()
+
+    transfers = arguments.transfers if arguments.transfers is not None else driver.concurrency
+
+    return cloud_fuse.Context(block_cache=block_cache, readahead_window=arguments.readahead,
+                              transfer_pool=helpers.transfer.TransferPool(transfers),
+                              compression=arguments.compression, chunker=chunker, metrics=metrics,
+                              journal_directory=journal_directory)
+
+
+#
+# Run one workload at one block size in a fresh working directory and database.
+# Setup runs against the plain local driver, so only the timed part pays for the simulated link.
+# When striping, setup stripes over local drivers the same way so that blocks are spread out.
+def run_workload(name, setup, run, block_size, arguments):
+    work_directory = tempfile.mkdtemp(prefix='cloud-fuse-benchmark-')
+    previous_directory = os.getcwd()
+
+    try:
+        os.chdir(work_directory)
+        os.makedirs('data12')
+
+        cloud_fuse.open_database('sqlite:///nodes.db')
+        cloud_fuse.dentry_cache = helpers.dentry.DentryCache()
+        cloud_fuse.BlockSize = block_size
+
+        if setup:
+            cloud_fuse.filesystem = drivers.filesystem.FileSystem()
+            if arguments.stripes > 1 and arguments.replicas <= 1:
+                cloud_fuse.filesystem = drivers.striped.StripedDriver(
+                    [cloud_fuse.filesystem] * arguments.stripes, arguments.placement)
+            setup(make_context(arguments, cloud_fuse.filesystem, 'setup-cache'), arguments)
+            cloud_fuse.session.remove()
+            cloud_fuse.dentry_cache = helpers.dentry.DentryCache()
+
+        driver = make_driver(arguments)
+        cloud_fuse.filesystem = driver
+        context = make_context(arguments, driver, 'block-cache',
+                               journal_directory='journal' if arguments.journal else None)
+        recorder = Recorder()
+
+        if arguments.trace_memory:
+            tracemalloc.start()
+
+        start = time.time()
+        start_times = os.times()
+        run(context, arguments, recorder)
+        end_times = os.times()
+        seconds = time.time() - start
+
+        if arguments.trace_memory:
+            traced_bytes, peak_traced_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        # Writes finish once they are in the journal. How long the uploads took after that is reported apart.
+        if context.journal:
+            drain_start = time.time()
+            context.journal.drain()
+            recorder.notes['journal'] = dict(context.journal.stats(), drain_seconds=time.time() - drain_start)
+            context.journal.close()
+
+        cloud_fuse.session.remove()
+    finally:
+        os.chdir(previous_directory)
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    mebibytes = recorder.bytes / (1024.0 * 1024.0)
+    # User and system time of the benchmark itself: copying and allocating shows up here, not in waiting.
+    cpu_seconds = sum(end_times[:2]) - sum(start_times[:2])
+
+    result = dict(
+        workload=name,
+        block_size=block_size,
+        seconds=seconds,
+        operations=len(recorder.latencies),
+        operations_per_second=len(recorder.latencies) / seconds if seconds else None,
+        bytes=recorder.bytes,
+        mib_per_second=mebibytes / seconds if seconds else None,
+        cpu_seconds=cpu_seconds,
+        cpu_seconds_per_mib=cpu_seconds / mebibytes if mebibytes else None,
+        latency=dict(
+            p50=percentile(recorder.latencies, 0.5),
+            p90=percentile(recorder.latencies, 0.9),
+            p99=percentile(recorder.latencies, 0.99),
+            max=max(recorder.latencies) if recorder.latencies else None
+        ),
+        driver=get_driver_stats(driver)
+    )
+    result.update(recorder.notes)
+
+    if arguments.trace_memory:
+        result['memory'] = dict(
+            peak_bytes=peak_traced_bytes,
+            peak_bytes_per_mib=peak_traced_bytes / mebibytes if mebibytes else None,
+            retained_bytes=traced_bytes
+        )
+
+    return result
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    workload_names = [name for name, functions in WORKLOADS]
+
+    parser = argparse.ArgumentParser(description='Benchmark cloud-fuse against a simulated remote driver.')
+    parser.add_argument('--workloads', nargs='+', default=workload_names, choices=workload_names)
+    parser.add_argument('--block-sizes', nargs='+', type=int, default=[65534, 262144, 1048576],
+                        help='block sizes in bytes to run every workload at')
+    parser.add_argument('--file-size', type=int, default=16,
+                        help='MiB written and read by the sequential and random workloads')
+    parser.add_argument('--io-size', type=int, default=128,
+                        help='KiB per sequential read or write, like FUSE requests')
+    parser.add_argument('--random-size', type=int, default=4,
+                        help='KiB per random read or write')
+    parser.add_argument('--random-operations', type=int, default=200)
+    parser.add_argument('--files', type=int, default=500,
+                        help='files created by the small file, readdir and stat workloads')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='times the readdir and stat workloads go over the directory')
+    parser.add_argument('--nodes', type=int, default=200000,
+                        help='files in the database the startup workload mounts')
+    parser.add_argument('--startup-target', type=float, default=1.0,
+                        help='seconds the startup workload should finish in')
+    parser.add_argument('--rtt', type=float, default=50,
+                        help='simulated round trip time in milliseconds')
+    parser.add_argument('--jitter', type=float, default=10,
+                        help='up to this many milliseconds are added to each round trip')
+    parser.add_argument('--bandwidth', type=float, default=10,
+                        help='simulated link bandwidth in MiB/s, 0 for unlimited')
+    parser.add_argument('--slow-rate', type=float, default=0.0,
+                        help='share of simulated calls that are slow')
+    parser.add_argument('--slow-delay', type=float, default=0,
+                        help='milliseconds added to each slow call')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help='calls per second each simulated provider accepts before turning calls away, 0 for no limit')
+    parser.add_argument('--request-rate', type=float, default=0,
+                        help='calls per second the scheduler makes to each provider, 0 to only slow down when turned away')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='chance of any driver call failing')
+    parser.add_argument('--driver-concurrency', type=int, default=8)
+    parser.add_argument('--stripes', type=int, default=1,
+                        help='stripe blocks across this many simulated providers, each with its own link')
+    parser.add_argument('--replicas', type=int, default=1,
+                        help='write every block to this many of the --stripes providers and hedge reads across them')
+    parser.add_argument('--placement', default=drivers.striped.ROUND_ROBIN,
+                        choices=[drivers.striped.ROUND_ROBIN, drivers.striped.HASH])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--transfers', type=int)
+    parser.add_argument('--readahead', type=int, default=32)
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help='block cache budget in MiB, 0 measures the driver without a cache')
+    parser.add_argument('--compression', default='raw', choices=helpers.compression.available_codecs())
+    parser.add_argument('--chunking', default='fixed', choices=['fixed', 'cdc'])
+    parser.add_argument('--journal', action='store_true',
+                        help='write blocks to a local journal and upload them in the background')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='measure the peak memory allocated per MiB moved, which slows every run down')
+    parser.add_argument('--output', help='file to write the results to, defaults to stdout')
+    arguments = parser.parse_args()
+
+    if arguments.trace_memory and not tracemalloc:
+        parser.error('--trace-memory needs Python 3.4 or later')
+
+    arguments.file_size *= 1024 * 1024
+    arguments.io_size *= 1024
+    arguments.random_size *= 1024
+
+    make_data(arguments.file_size, 1)
+    make_data(arguments.random_size, 4)
+
+    # The filesystem prints on every operation, which is not what is being measured.
+    real_stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+
+    results = []
+    try:
+        for name, (setup, run) in WORKLOADS:
+            if name not in arguments.workloads:
+                continue
+
+            for block_size in arguments.block_sizes:
+                results.append(run_workload(name, setup, run, block_size, arguments))
+                print("{} at {} bytes: {:.3f}s".format(name, block_size, results[-1]['seconds']),
+                      file=sys.stderr)
+                if results[-1].get('met_target') is False:
+                    print("{} missed its target of {}s".format(name, results[-1]['target_seconds']),
+                          file=sys.stderr)
+    finally:
+        sys.stdout.close()
+        sys.stdout = real_stdout
+
+    report = dict(
+        commit=get_commit(),
+        python=platform.python_version(),
+        time=time.time(),
+        settings=dict((key, value) for key, value in vars(arguments).items() if key != 'output'),
+        results=results
+    )
+
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
@@ -6,24 +6,45 @@
 
 from __future__ import print_function, absolute_import, division
 
+import argparse
 import hashlib
 import logging
-import math
-import md5
 import os
+import collections
 import importlib
+import itertools
+import json
+import threading
 
 import helpers.blocks
+import helpers.cache
+import helpers.chunking
+import helpers.collector
+import helpers.compression
+import helpers.dentry
+import helpers.journal
+import helpers.metrics
+import helpers.readahead
+import helpers.trace
+import helpers.transfer
+import helpers.writeback
 import helpers.filesystem
 import helpers.database
-
-from errno import ENOENT
+import drivers.deferred
+import drivers.filesystem
+import drivers.metered
+import drivers.replicated
+import drivers.scheduled
+import drivers.striped
+
+from errno import EINVAL, EIO, EISDIR, ENOENT, ENOTDIR, ENOTEMPTY
 from stat import S_IFDIR, S_IFREG
-from sys import argv, exit
+from sys import exit
 from time import time
 
-from sqlalchemy import Column, String, Integer, ForeignKey, create_engine, Boolean, Date
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy import Column, String, Integer, ForeignKey, create_engine, Boolean, Date, Index, func, inspect, text
+from sqlalchemy.orm import relationship, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn, fuse_get_context
@@ -31,15 +52,26 @@ from fuse import FUSE, FuseOSError, Operations, LoggingMixIn, fuse_get_context
 # Base from sqlalchemy orm so that we can derive classes from it.
 Base = declarative_base()
 BlockSize = 65534
+# Version of the data in the database. 1: every block is stored under the md5 of its contents.
+DataVersion = 1
+
+dentry_cache = helpers.dentry.DentryCache()
+
+# Per operation messages go through here so that they cost nothing unless debug logging is on.
+log = logging.getLogger('cloud-fuse')
 
 
 class Node(Base):
     __tablename__ = 'node'
+    __table_args__ = (Index('node_parent_name', 'parent_id', 'name'),)
     id = Column(Integer, primary_key=True)
     parent_id = Column(Integer, ForeignKey('node.id'))
     children = relationship("Node")
     name = Column(String)
-    size = Column(Integer)
+    size = Column(Integer, default=0)
+    block_count = Column(Integer, default=0)
+    # Set once the file has been written in content-defined chunks rather than BlockSize blocks.
+    chunked = Column(Boolean, default=False)
     permissions = Column(Integer)
     directory = Column(Boolean)
     create_time = Column(Date)
@@ -57,62 +89,466 @@ class Node(Base):
         child_nodes = []
 
         for row in session.query(Node).order_by(Node.id).filter(Node.parent == parent).all():
-            print(row.name)
+            log.debug("Found child %s", row.name)
             child_nodes.append(row)
 
         return child_nodes
 
+    #
+    # Return the names in a directory, None being the root. A directory is only loaded
+    # when it is listed, and its entries go into the dentry cache on the way so that
+    # looking up the files that were just listed needs no further queries.
+    @staticmethod
+    def get_child_names(parent_id):
+        names = []
+
+        for child in session.query(Node).filter(Node.parent_id == parent_id):
+            dentry_cache.put_entry(parent_id, child.name, child.id)
+            dentry_cache.put_node(child)
+            names.append(child.name)
+
+        return names
+
+    #
+    # Count the subdirectories of a directory, None being the root, without loading its children.
+    @staticmethod
+    def count_subdirectories(parent_id):
+        return session.query(func.count(Node.id)).filter(Node.parent_id == parent_id,
+                                                         Node.directory.is_(True)).scalar()
+
+    #
+    # Resolve an absolute path to its node. Returns None for the root directory
+    # and False if nothing exists at the path. Lookups, including ones that fail,
+    # are remembered in the dentry cache so a hot path resolves without any query.
     @staticmethod
     def get_node_from_abs_path(path):
-        split_path = path.split("/")
+        cached, node_id = dentry_cache.get_path(path)
 
-        last_parent_node = None
+        if not cached:
+            node_id = None
 
-        for path_section in split_path:
-            print("Working on path segment: {}".format(path_section))
-            if path_section == "":
-                continue
+            for path_section in path.split("/"):
+                if path_section == "":
+                    continue
 
-            try:
-                print("Looking for node with parentid {} and name {}".format(last_parent_node, path_section))
-                last_parent_node = session.query(Node).order_by(Node.id).filter(Node.parent == last_parent_node,
-                                                                                Node.name == path_section).one()
-                print("Found match for: {}, which was: {}".format(path_section, Node.id))
-            except:
-                # No file existed in this path
+                cached, child_id = dentry_cache.get_entry(node_id, path_section)
+
+                if not cached:
+                    if node_id is None:
+                        row = session.execute(FIND_TOP_LEVEL_NODE, dict(name=path_section)).first()
+                    else:
+                        row = session.execute(FIND_CHILD_NODE, dict(parent_id=node_id, name=path_section)).first()
+                    child_id = row.id if row else None
+                    dentry_cache.put_entry(node_id, path_section, child_id)
+
+                if child_id is None:
+                    # No file existed in this path
+                    dentry_cache.put_path(path, None)
+                    return False
+
+                node_id = child_id
+
+            if node_id is None:
+                # The root directory does not have a node.
+                return None
+
+            dentry_cache.put_path(path, node_id)
+
+        if node_id is None:
+            return False
+
+        node, current = dentry_cache.get_node(node_id)
+
+        if not current:
+            if node is None:
+                # The session may still hold a copy that another thread has since changed.
+                node = session.query(Node).populate_existing().get(node_id)
+            else:
+                session.expire(node)
+
+            if node is None:
+                dentry_cache.invalidate(path)
                 return False
 
-        return last_parent_node
+            dentry_cache.put_node(node)
+
+        return node
+
+    #
+    # Return the block stored at a position, preferring the newest row if there are several.
+    def get_block(self, position):
+        return session.query(Block).filter(Block.node == self.id, Block.position == position)\
+            .order_by(Block.id.desc()).first()
+
+    #
+    # Return position -> (hash, codec) for the blocks from first_position to
+    # last_position, or for every block of the file, in one query.
+    def get_stored_blocks(self, first_position=None, last_position=None):
+        query = session.query(Block.position, Block.hash, Block.codec).filter(Block.node == self.id)
+
+        if first_position is not None:
+            query = query.filter(Block.position.between(first_position, last_position))
+
+        return dict((position, (block_hash, codec)) for position, block_hash, codec in query.order_by(Block.id))
+
+    #
+    # Return (id, position, file_offset, size, hash, codec) rows for the newest row of
+    # every block overlapping bytes [offset, offset + size), in file order.
+    def get_blocks_in_range(self, offset, size):
+        blocks = collections.OrderedDict()
+
+        for block in session.execute(FIND_BLOCKS_IN_RANGE, dict(node=self.id, offset=offset, end=offset + size)):
+            blocks[block.position] = block
+
+        return list(blocks.values())
 
     def get_size(self):
-        print("Getting size for node with name: {}".format(self.name))
+        return self.size or 0
+
+    #
+    # Recompute the block count of every file from its blocks, and make sure its size
+    # reaches the end of its last block, returning the nodes that were out of date.
+    # A file can be larger than its blocks, as it may end in a hole.
+    @staticmethod
+    def check_sizes():
+        totals = dict((node_id, (total_size, block_count)) for node_id, total_size, block_count in
+                      session.query(Block.node, func.max(Block.file_offset + Block.size), func.count(Block.id))
+                      .group_by(Block.node))
+        fixed_nodes = []
 
-        total_size = 0
+        for node in session.query(Node).filter(Node.directory.isnot(True)):
+            total_size, block_count = totals.get(node.id, (0, 0))
+            total_size = max(total_size or 0, node.size or 0)
 
-        for file_block in self.blocks:
-            print("Found block with size: {}".format(file_block.size))
-            total_size += file_block.size
+            if node.size != total_size or node.block_count != block_count:
+                print("Node {} has size {} and {} blocks, expected size {} and {} blocks".format(
+                    node.id, node.size, node.block_count, total_size, block_count))
+                node.size = total_size
+                node.block_count = block_count
+                fixed_nodes.append(node)
 
-        return total_size
+        session.commit()
+
+        return fixed_nodes
 
 
 class Block(Base):
     __tablename__ = 'block'
+    __table_args__ = (Index('block_node_position', 'node', 'position'),
+                      Index('block_node_offset', 'node', 'file_offset'),
+                      Index('block_hash', 'hash'))
     id = Column(Integer, primary_key=True)
     hash = Column(String)
     size = Column(Integer)
     node = Column(Integer, ForeignKey('node.id'))
     position = Column(Integer)
+    # Where the block starts in the file. Fixed size blocks start at (position - 1) * BlockSize,
+    # content-defined chunks wherever the chunker cut the file.
+    file_offset = Column(Integer)
+    # How the stored object is compressed, and its size once compressed.
+    codec = Column(String, default=helpers.compression.RAW)
+    stored_size = Column(Integer)
+    # Which driver of a drivers.striped.StripedDriver holds the stored object, None without striping.
+    stripe = Column(Integer)
+
+    #
+    # Blocks are stored once per distinct content, so every row sharing a hash is a reference to the same object.
+    @staticmethod
+    def count_references(block_hash):
+        return session.execute(COUNT_REFERENCES, dict(hash=block_hash)).scalar()
+
+    #
+    # Return the (codec, stored_size, stripe) of the stored object for a hash, or None if it is not stored.
+    @staticmethod
+    def find_stored(block_hash):
+        return session.execute(FIND_STORED_BLOCK, dict(hash=block_hash)).first()
+
+    #
+    # Return the stripe holding a stored block, given its name. Called by StripedDriver
+    # from transfer threads, so it runs outside of their sessions.
+    @staticmethod
+    def find_stripe(block_name):
+        return session.get_bind().execute(FIND_STRIPE, hash=block_name.rsplit('/', 1)[-1]).scalar()
+
+    #
+    # Return the hashes starting with prefix that any row refers to.
+    @staticmethod
+    def find_referenced(prefix):
+        # Hashes are lower case hex, so every hash starting with prefix sorts before the one
+        # with its last character bumped, and the range is an index seek.
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+        return set(row.hash for row in session.execute(FIND_REFERENCED_HASHES, dict(start=prefix, end=end)))
+
+    @staticmethod
+    def has_blocks():
+        return session.query(Block.id).first() is not None
+
+    #
+    # Give blocks written before file_offset existed the offset of their fixed size position.
+    @staticmethod
+    def fill_offsets():
+        session.query(Block).filter(Block.file_offset.is_(None))\
+            .update({Block.file_offset: (Block.position - 1) * BlockSize}, synchronize_session=False)
+        session.commit()
+
+
+#
+# A stored block that the last garbage collection found nothing referring to. The next
+# one only deletes the blocks it finds orphaned again.
+class SuspectedOrphan(Base):
+    __tablename__ = 'suspected_orphan'
+    hash = Column(String, primary_key=True)
+
+    @staticmethod
+    def load():
+        return set(block_hash for block_hash, in session.query(SuspectedOrphan.hash))
+
+    @staticmethod
+    def save(block_hashes):
+        session.query(SuspectedOrphan).delete(synchronize_session=False)
+        session.add_all([SuspectedOrphan(hash=block_hash) for block_hash in block_hashes])
+        session.commit()
+
+
+# Lookups made on every path resolution, read and flush are plain SQL, which skips
+# the ORM. They do not autoflush, so pending changes must be flushed first.
+FIND_CHILD_NODE = text('SELECT id FROM node WHERE parent_id = :parent_id AND name = :name ORDER BY id LIMIT 1')
+FIND_TOP_LEVEL_NODE = text('SELECT id FROM node WHERE parent_id IS NULL AND name = :name ORDER BY id LIMIT 1')
+# The first block is the one starting at or before offset, found with one index seek, so
+# reading the end of a file with millions of blocks does not walk all the ones before it.
+FIND_BLOCKS_IN_RANGE = text(
+    'SELECT id, position, file_offset, size, hash, codec FROM block '
+    'WHERE node = :node AND file_offset < :end AND file_offset + size > :offset AND file_offset >= '
+    '  coalesce((SELECT max(file_offset) FROM block WHERE node = :node AND file_offset <= :offset), 0) '
+    'ORDER BY file_offset, id')
+FIND_STORED_BLOCK = text('SELECT codec, stored_size, stripe FROM block WHERE hash = :hash LIMIT 1')
+FIND_STRIPE = text('SELECT stripe FROM block WHERE hash = :hash AND stripe IS NOT NULL LIMIT 1')
+COUNT_REFERENCES = text('SELECT count(*) FROM block WHERE hash = :hash')
+FIND_REFERENCED_HASHES = text('SELECT DISTINCT hash FROM block WHERE hash >= :start AND hash < :end')
+# Rows that nothing reads: those of nodes that are gone, and all but the newest row of a position.
+FIND_DETACHED_BLOCKS = text('SELECT id, hash FROM block WHERE node IS NULL OR node NOT IN (SELECT id FROM node)')
+FIND_NODES_WITH_SUPERSEDED_BLOCKS = text(
+    'SELECT DISTINCT node FROM (SELECT node FROM block WHERE node IS NOT NULL GROUP BY node, position '
+    'HAVING count(*) > 1)')
+FIND_SUPERSEDED_BLOCKS = text(
+    'SELECT id, hash FROM block WHERE node = :node AND id NOT IN '
+    '  (SELECT max(id) FROM block WHERE node = :node GROUP BY position)')
+
+
+# State kept for each file handle returned from open/create.
+class FileHandle:
+    def __init__(self, path, node_id, write_buffer, readahead=None):
+        self.path = path
+        self.node_id = node_id
+        self.write_buffer = write_buffer
+        self.readahead = readahead
+        # Block position -> (content hash, codec).
+        self.stored_blocks = {}
 
 
 # Main class passed to fuse - this is where we define the functions that are called by fuse.
 class Context(LoggingMixIn, Operations):
+    def __init__(self, block_cache=None, readahead_window=32, write_buffer_size=64 * 1024 * 1024,
+                 transfer_pool=None, compression=None, chunker=None, metrics=None, trace=None, journal_directory=None,
+                 journal_size=1024 * 1024 * 1024, collect_interval=0, collect_rate=2.0, collect_dry_run=False):
+        self.block_cache = block_cache
+        self.metrics = metrics or helpers.metrics.Metrics()
+        # A helpers.trace.TraceRecorder that every FUSE operation is recorded to, if given.
+        self.trace = trace
+        # Files are split into BlockSize blocks unless a helpers.chunking.Chunker is given.
+        self.chunker = chunker
+        self.compression = compression
+        self.transfer_pool = transfer_pool or helpers.transfer.TransferPool(0)
+        self.readahead_window = readahead_window
+        self.write_buffer_size = write_buffer_size
+        self.file_handles = {}
+        self.file_handle_counter = itertools.count(1)
+        # Block directories known to exist on the driver.
+        self.block_directories = set()
+
+        # Guards file_handles, file_locks and write_buffers.
+        self.handles_lock = threading.Lock()
+        # Node id -> lock serialising changes to the blocks and buffers of that file.
+        self.file_locks = {}
+        # Node id -> [write buffer, number of handles using it]. The handles of a file share
+        # one buffer, so the last write to a byte wins whichever handle made it.
+        self.write_buffers = {}
+        # Guards deciding whether a stored block can be reused or deleted.
+        self.block_lock = threading.Lock()
+        # Block hash -> number of flushes in progress that are about to reference it.
+        self.pinned_hashes = collections.Counter()
+        # Released blocks are deleted from the driver by delete_pool rather than by the thread
+        # releasing them, and while they wait to be, pinning one calls its deletion off. A
+        # block being deleted right now has to be gone before it can be stored again.
+        self.pending_deletes = set()
+        self.deleting = set()
+        self.deleted = threading.Condition(self.block_lock)
+        self.delete_pool = helpers.transfer.TransferPool(min(self.transfer_pool.workers, 4))
+        # Block hash -> [(codec, stored size, stripe), number of truncates] for stored blocks that were
+        # cut out of a file still open, as it is usually about to be written again with the same
+        # contents. They stay pinned, and are reused by store_blocks, until the last handle on the
+        # file is released. Node id -> the hashes cut out of it.
+        self.truncated_blocks = {}
+        self.truncated_hashes = {}
+
+        # With a journal, blocks are uploaded in the background once they are in it, and
+        # whatever a crash left in it is uploaded now.
+        self.journal = None
+        if journal_directory:
+            self.journal = helpers.journal.UploadJournal(journal_directory, self.send_block,
+                                                         max(self.transfer_pool.workers, 1), journal_size)
+
+        # Stored blocks and rows nothing refers to are looked for every collect_interval
+        # seconds, or when collector.run() is called.
+        self.collector = helpers.collector.GarbageCollector(self.list_block_directory, Block.find_referenced,
+                                                            self.collect_stored_block, self.compact_blocks,
+                                                            Block.has_blocks, SuspectedOrphan.load,
+                                                            SuspectedOrphan.save, collect_rate, collect_dry_run)
+        if collect_interval:
+            self.collector.start(collect_interval)
+
+    def file_lock(self, node_id):
+        with self.handles_lock:
+            if node_id not in self.file_locks:
+                self.file_locks[node_id] = threading.RLock()
+
+            return self.file_locks[node_id]
+
+    #
+    # Every FUSE operation comes through here. LoggingMixIn formats the arguments of
+    # every call, so it is only used when its debug output would be shown.
+    def __call__(self, op, *args):
+        self.metrics.begin_operation(op)
+        start = time()
+        result = None
+        error = 0
+
+        try:
+            if LoggingMixIn.log.isEnabledFor(logging.DEBUG):
+                result = LoggingMixIn.__call__(self, op, *args)
+            else:
+                result = Operations.__call__(self, op, *args)
+
+            return result
+        except OSError as exception:
+            error = exception.errno or 0
+            raise
+        finally:
+            latency = time() - start
+            self.metrics.end_operation(op, latency)
+
+            if self.trace:
+                self.trace.record(op, args, result, start, latency, error)
+
+    #
+    # Metrics together with the state of the caches, as served on the stats socket.
+    def stats(self):
+        stats = self.metrics.snapshot()
+        stats['dentry_cache'] = dentry_cache.stats()
+
+        if self.block_cache:
+            stats['block_cache'] = self.block_cache.stats()
+
+        if self.journal:
+            stats['journal'] = self.journal.stats()
+
+        stats['collector'] = self.collector.stats()
+
+        # Composite drivers keep their own statistics, such as the latency of each replica.
+        if hasattr(filesystem, 'stats'):
+            stats['driver'] = filesystem.stats()
+
+        return stats
+
     def removexattr(self, att1, att2):
         return 0
 
+    def destroy(self, path):
+        if self.trace:
+            self.trace.close()
+
+        self.collector.close()
+
+        with self.block_lock:
+            while self.pending_deletes or self.deleting:
+                self.deleted.wait()
+
+        if self.journal:
+            self.journal.close()
+
+        if self.block_cache:
+            print("Block cache statistics: {}".format(self.block_cache.stats()))
+
+    #
+    # Blocks are stored under the hash of their contents rather than the path of their
+    # file, so a rename only moves the node row, however large the file or directory is.
     def rename(self, old, new):
-        # Do something here
-        return os.EEXIST
+        node_to_move = Node.get_node_from_abs_path(old)
+
+        if not node_to_move:
+            raise FuseOSError(ENOENT)
+
+        if new.startswith(old.rstrip('/') + '/'):
+            # A directory cannot be moved inside itself.
+            raise FuseOSError(EINVAL)
+
+        parent_path, new_name = new.rsplit('/', 1)
+        new_parent = Node.get_node_from_abs_path(parent_path) if parent_path else None
+
+        if new_parent is False:
+            raise FuseOSError(ENOENT)
+        if new_parent and not new_parent.directory:
+            raise FuseOSError(ENOTDIR)
+
+        new_parent_id = new_parent.id if new_parent else None
+        old_parent_id, old_name = node_to_move.parent_id, node_to_move.name
+        replaced_node = Node.get_node_from_abs_path(new)
+        block_hashes = set()
+
+        if replaced_node:
+            if replaced_node.id == node_to_move.id:
+                return 0
+
+            if replaced_node.directory and not node_to_move.directory:
+                raise FuseOSError(EISDIR)
+            if node_to_move.directory and not replaced_node.directory:
+                raise FuseOSError(ENOTDIR)
+            if replaced_node.directory and Node.get_child_names(replaced_node.id):
+                raise FuseOSError(ENOTEMPTY)
+
+            # Replacing a file drops it in the same commit, as rename over an existing file must be atomic.
+            replaced_id = replaced_node.id
+            with self.file_lock(replaced_id):
+                block_hashes = self.delete_blocks(replaced_node)
+                session.delete(replaced_node)
+
+        node_to_move.parent_id = new_parent_id
+        node_to_move.name = new_name
+        session.commit()
+
+        dentry_cache.invalidate(old, old_parent_id, old_name)
+        dentry_cache.invalidate(new, new_parent_id, new_name)
+        dentry_cache.touch_node(node_to_move.id)
+        for parent_id in set([old_parent_id, new_parent_id]) - set([None]):
+            dentry_cache.touch_node(parent_id)
+
+        if replaced_node:
+            dentry_cache.invalidate_node(replaced_id)
+            with self.handles_lock:
+                self.file_locks.pop(replaced_id, None)
+
+        # Open files keep working, under their new path.
+        old_prefix = old.rstrip('/') + '/'
+        with self.handles_lock:
+            for handle in self.file_handles.values():
+                if handle.path == old or handle.path.startswith(old_prefix):
+                    handle.path = new + handle.path[len(old):]
+
+        for block_hash in block_hashes:
+            self.release_stored_block(block_hash)
+
+        return 0
 
     def statfs(self, path):
         return dict(
@@ -128,95 +564,358 @@ class Context(LoggingMixIn, Operations):
         node_for_path = Node.get_node_from_abs_path(path)
         if node_for_path:
             if (node_for_path.directory):
-                attr = dict(st_mode=(S_IFDIR | 0o755), st_nlink=2 + len(node_for_path.children), st_size=0)
+                attr = dict(st_mode=(S_IFDIR | 0o755), st_nlink=2 + Node.count_subdirectories(node_for_path.id),
+                            st_size=0)
             else:
                 attr = dict(st_mode=(S_IFREG | 0o755), st_nlink=1,
-                            st_size=node_for_path.get_size())
+                            st_size=self.get_file_size(path, node_for_path))
         elif path == '/':
-            attr = dict(st_mode=(S_IFDIR | 0o755), st_nlink=2 + len(Node.get_top_level_nodes()))
+            attr = dict(st_mode=(S_IFDIR | 0o755), st_nlink=2 + Node.count_subdirectories(None))
         else:
             raise FuseOSError(ENOENT)
 
         attr['st_ctime'] = attr['st_mtime'] = time()
         return attr
 
+    #
+    # Drop the blocks past the new end of the file and cut down the one it now ends in.
+    # Growing a file stores nothing, the new part is a hole that reads back as zeros.
     def truncate(self, path, length, fh=None):
-        block_path = helpers.blocks.get_block_root(path)
+        node_to_truncate = Node.get_node_from_abs_path(path)
+
+        if not node_to_truncate:
+            raise FuseOSError(ENOENT)
+
+        log.debug("Truncating %s to %d bytes", path, length)
+
+        superseded_hashes = []
+
+        with self.file_lock(node_to_truncate.id):
+            pinned_hashes = []
+
+            try:
+                # Another thread may have changed the node since this session loaded it.
+                node = session.query(Node).populate_existing().get(node_to_truncate.id)
+
+                for block in session.query(Block).filter(Block.node == node.id, Block.file_offset + Block.size > length):
+                    superseded_hashes.append((block.hash, (block.codec, block.stored_size, block.stripe)))
+
+                    # Pinned until it is known whether the block is kept for a rewrite.
+                    with self.block_lock:
+                        self.pinned_hashes[block.hash] += 1
+                        pinned_hashes.append(block.hash)
+
+                    if block.file_offset >= length:
+                        session.delete(block)
+                        node.block_count = (node.block_count or 0) - 1
+                        continue
+
+                    contents = self.load_block(block.hash, block.codec)
+                    if contents is False or contents is None:
+                        session.rollback()
+                        raise FuseOSError(EIO)
+
+                    contents = contents[:length - block.file_offset]
+                    block_hash = hashlib.md5(contents).hexdigest()
+                    stored_object = self.store_blocks({block_hash: contents}, pinned_hashes)[block_hash]
+
+                    if not stored_object:
+                        session.rollback()
+                        raise FuseOSError(EIO)
+
+                    block.hash = block_hash
+                    block.codec, block.stored_size, block.stripe = stored_object
+                    block.size = len(contents)
+
+                node.size = length
+                session.commit()
 
-        print("Deleting all files in: {}".format(block_path))
+                # Truncating an open file, as opening it with O_TRUNC does, usually comes before writing it again.
+                if self.get_write_buffer(node.id) is not None:
+                    self.keep_truncated_blocks(node.id, superseded_hashes)
+                    superseded_hashes = []
+            finally:
+                self.unpin_hashes(pinned_hashes)
 
-        for block in Node.get_node_from_abs_path(path).blocks:
-            filesystem.delete_file(block_path + block.position)
+            dentry_cache.touch_node(node.id)
+
+            write_buffer = self.get_write_buffer(node.id)
+            if write_buffer:
+                write_buffer.truncate(length)
+
+            stored_blocks = node.get_stored_blocks()
+            for handle in self.handles_for_node(node.id):
+                handle.stored_blocks = dict(stored_blocks)
+                if handle.readahead:
+                    handle.readahead.reset()
+
+        for block_hash, stored_object in superseded_hashes:
+            self.release_stored_block(block_hash)
+
+        return 0
+
+    def keep_truncated_blocks(self, node_id, truncated_blocks):
+        with self.block_lock:
+            for block_hash, stored_object in truncated_blocks:
+                self.pinned_hashes[block_hash] += 1
+                self.truncated_blocks.setdefault(block_hash, [stored_object, 0])[1] += 1
+                self.truncated_hashes.setdefault(node_id, []).append(block_hash)
+
+    #
+    # Release the blocks kept since the file was truncated, once nothing can write them again.
+    def release_truncated_blocks(self, node_id):
+        with self.block_lock:
+            block_hashes = self.truncated_hashes.pop(node_id, [])
+
+            for block_hash in block_hashes:
+                entry = self.truncated_blocks[block_hash]
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.truncated_blocks[block_hash]
+
+        self.unpin_hashes(block_hashes)
+
+        for block_hash in block_hashes:
+            self.release_stored_block(block_hash)
+
+    def unlink(self, path):
+        node_to_unlink = Node.get_node_from_abs_path(path)
+
+        if not node_to_unlink:
+            raise FuseOSError(ENOENT)
+
+        node_id, parent_id, name = node_to_unlink.id, node_to_unlink.parent_id, node_to_unlink.name
+
+        with self.file_lock(node_id):
+            block_hashes = self.delete_blocks(node_to_unlink)
+            session.delete(node_to_unlink)
+            session.commit()
+
+        dentry_cache.invalidate(path, parent_id, name)
+        dentry_cache.invalidate_node(node_id)
+        if parent_id is not None:
+            dentry_cache.touch_node(parent_id)
+
+        with self.handles_lock:
+            self.file_locks.pop(node_id, None)
+
+        for block_hash in block_hashes:
+            self.release_stored_block(block_hash)
+
+        return 0
+
+    #
+    # Delete the block rows of a node, returning the hashes they referenced so
+    # that the stored blocks can be released once the change is committed.
+    def delete_blocks(self, node):
+        block_hashes = set()
+
+        for block in list(node.blocks):
+            block_hashes.add(block.hash)
+            session.delete(block)
+
+        return block_hashes
 
     def read(self, path, size, offset, fh):
-        print("Processing read request for size: {}".format(size))
+        log.debug("Processing read request for size: %d", size)
         node_to_read = Node.get_node_from_abs_path(path)
-        block_size = BlockSize
 
         if not node_to_read:
             raise RuntimeError('Could not find node for path: %r' % path)
 
-        offset_from_first_block = offset % block_size
-        first_block = int(math.ceil(offset / block_size))
-        number_of_blocks = int(math.ceil((offset_from_first_block + size) / block_size))
+        return self.read_bytes(path, node_to_read, offset, size, self.file_handles.get(fh))
 
-        if number_of_blocks > len(node_to_read.blocks):
-            number_of_blocks = len(node_to_read.blocks)
+    #
+    # Return bytes [offset, offset + size) of a file as it currently reads: the stored
+    # blocks, with the writes still buffered on any handle open on the path applied
+    # on top. Anything not covered by either is a hole and reads back as zeros, but a
+    # stored block that cannot be fetched fails the read with EIO.
+    def read_bytes(self, path, node, offset, size, handle=None):
+        file_size = self.get_file_size(path, node)
+        if offset >= file_size:
+            return b""
 
-        print("Number of blocks: {}".format(number_of_blocks))
+        size = min(size, file_size - offset)
+        end = offset + size
 
-        if offset == 0:
-            first_block = 1
+        # Buffered writes are collected before looking up the stored blocks, so a flush
+        # running in between can only make the stored blocks newer.
+        with self.file_lock(node.id):
+            write_buffer = self.get_write_buffer(node.id)
+            dirty_extents = write_buffer.extents_in_range(offset, size) if write_buffer else []
 
-        file_content = ""
+        stored_blocks = node.get_blocks_in_range(offset, size)
+        readahead = handle.readahead if handle else None
 
-        for current_block_index in range(first_block, first_block + number_of_blocks - 1):
-            if (current_block_index == first_block):
-                print("Reading from first block")
-                bytes_to_read = block_size - offset_from_first_block
+        if readahead and stored_blocks:
+            readahead.access(stored_blocks[0].position, stored_blocks[-1].position,
+                             max(handle.stored_blocks or [0]))
 
-                if size < bytes_to_read:
-                    bytes_to_read = size
+        # (file offset, contents) of everything that makes up the result, in the order it is
+        # applied. Contents are memoryviews of the blocks wherever that saves a copy.
+        pieces = []
+        to_fetch = []
 
-                offset_for_block = offset_from_first_block
-            elif (current_block_index == first_block + (number_of_blocks - 1)):
-                print("Reading from last block")
-                # Number of bytes read so far
-                bytes_read_so_far = (block_size - offset_from_first_block) + (block_size * (first_block + number_of_blocks - 1) - 2)
-                bytes_to_read = size - bytes_read_so_far
-                offset_for_block = 0
+        for block in stored_blocks:
+            start = max(offset, block.file_offset)
+            offset_for_block = start - block.file_offset
+            bytes_to_read = min(end, block.file_offset + block.size) - start
+
+            contents = readahead.get(block.position) if readahead else None
+
+            if contents is None:
+                to_fetch.append((block.hash, block.codec, block.size, offset_for_block, bytes_to_read, start))
+            else:
+                pieces.append((start, helpers.blocks.view_range(contents, offset_for_block, bytes_to_read)))
+
+        # Random reads of part of a block only fetch that part when the driver can;
+        # sequential reads fetch whole blocks so that they land in the block cache.
+        use_ranges = filesystem.supports_read_range and not (readahead and readahead.window)
+
+        def fetch_piece(piece):
+            block_hash, codec, block_size, offset_for_block, bytes_to_read, start = piece
+
+            if use_ranges and bytes_to_read < block_size:
+                contents = self.load_block_range(block_hash, codec, offset_for_block, bytes_to_read)
             else:
-                bytes_to_read = block_size
-                offset_for_block = 0
+                contents = self.load_block(block_hash, codec)
+                if contents is not False and contents is not None:
+                    contents = helpers.blocks.view_range(contents, offset_for_block, bytes_to_read)
+
+            if contents is False or contents is None:
+                log.warning("Could not fetch block %s", block_hash)
+                raise FuseOSError(EIO)
+
+            return contents
 
-            print("Would read {} bytes from block #{} at offset {}".format(bytes_to_read, current_block_index,
-                                                                           offset_for_block))
+        # Everything else comes from the driver, fetched concurrently. A stored block
+        # that comes back short leaves zeros behind it.
+        for piece, contents in zip(to_fetch, self.transfer_pool.map(fetch_piece, to_fetch)):
+            pieces.append((piece[-1], contents))
 
-            block_path = helpers.blocks.get_block_root(path)
+        pieces.extend(dirty_extents)
 
-            print("Reading {} bytes from {} at offset {}".format(bytes_to_read, block_path + str(current_block_index),
-                                                                 offset_for_block))
-            print("Reading whole block")
-            whole_block_contents = filesystem.readFile(helpers.blocks.get_block_root(path) + str(current_block_index))
-            block_contents_from_offset = whole_block_contents[offset_for_block:(offset_for_block + bytes_to_read)]
+        # A read that one block or buffered write answers in full needs no assembling.
+        if len(pieces) == 1 and pieces[0][0] == offset and len(pieces[0][1]) == size:
+            return helpers.blocks.to_bytes(pieces[0][1])
 
-            print("Would return content with size of: {}".format(len(block_contents_from_offset)))
+        file_content = bytearray(size)
 
-            file_content += block_contents_from_offset
-            print("Total length after this block: {}".format(len(file_content)))
+        for start, contents in pieces:
+            file_content[start - offset:start - offset + len(contents)] = contents
 
-        return file_content
+        return bytes(file_content)
+
+    #
+    # Yield bytes [start, end) of a file as it currently reads, a buffer at a time.
+    def iterate_bytes(self, path, node, start, end, buffer_size=1024 * 1024):
+        for offset in range(start, end, buffer_size):
+            yield self.read_bytes(path, node, offset, min(buffer_size, end - offset))
+
+    def read_stored_block(self, node, index):
+        block_instance = node.get_block(index)
+
+        if block_instance is None:
+            return False
+
+        return self.load_block(block_instance.hash, block_instance.codec)
+
+    #
+    # Fetch a block by its hash through the local block cache, which holds blocks
+    # uncompressed. This is called from transfer and read-ahead threads, so it must
+    # not use the database session.
+    def load_block(self, block_hash, codec):
+        if not block_hash:
+            return False
+
+        block_name = helpers.blocks.get_block_name(block_hash)
+
+        if self.block_cache:
+            contents = self.block_cache.get(block_name, block_hash)
+            if contents is not None:
+                return contents
+
+        contents = self.journal.read(block_name) if self.journal else None
+        if contents is None:
+            contents = filesystem.readFile(block_name)
+
+        if contents:
+            contents = helpers.compression.decompress(contents, codec)
+
+        if contents and self.block_cache:
+            self.block_cache.put(block_name, contents)
+
+        return contents
+
+    #
+    # Load a block for read-ahead, which waits behind reads that are needed now.
+    def prefetch_block(self, block_hash, codec):
+        with drivers.scheduled.priority(drivers.scheduled.PREFETCH):
+            return self.load_block(block_hash, codec)
+
+    #
+    # Fetch part of a block, from the block cache if it holds the whole block and
+    # otherwise with a ranged read from the driver. Compressed blocks can only be
+    # read whole. Safe to call from transfer threads. The part may be returned as a
+    # memoryview of the whole block.
+    def load_block_range(self, block_hash, codec, offset, length):
+        if not block_hash:
+            return False
+
+        if codec and codec != helpers.compression.RAW:
+            contents = self.load_block(block_hash, codec)
+            if contents is False or contents is None:
+                return False
+
+            return helpers.blocks.view_range(contents, offset, length)
+
+        block_name = helpers.blocks.get_block_name(block_hash)
+
+        if self.block_cache:
+            contents = self.block_cache.get(block_name, block_hash)
+            if contents is not None:
+                return helpers.blocks.view_range(contents, offset, length)
+
+        contents = self.journal.read(block_name) if self.journal else None
+        if contents is not None:
+            return helpers.blocks.view_range(contents, offset, length)
+
+        return filesystem.read_range(block_name, offset, length)
+
+    def get_file_size(self, path, node):
+        # Writes that have not been flushed yet can extend the file.
+        write_buffer = self.get_write_buffer(node.id)
+
+        return max(node.get_size(), write_buffer.end if write_buffer else 0)
+
+    #
+    # Return the buffer of writes to a file not flushed yet, or None if it is not open.
+    def get_write_buffer(self, node_id):
+        with self.handles_lock:
+            entry = self.write_buffers.get(node_id)
+
+        return entry[0] if entry else None
 
     def readdir(self, path, fh):
-        return ['.', '..'] + [node_in_path.name for node_in_path in Node.get_children_of_node(Node.get_node_from_abs_path(path))]
+        directory = Node.get_node_from_abs_path(path)
+
+        # None is the root directory, False a path that does not exist.
+        if directory is False:
+            raise FuseOSError(ENOENT)
+
+        if directory is not None and not directory.directory:
+            raise FuseOSError(ENOTDIR)
+
+        return ['.', '..'] + Node.get_child_names(directory.id if directory else None)
 
     def mkdir(self, path, mode):
         if not Node.get_node_from_abs_path(path):
             if len(path.split('/')[:-1]) == 1:
-                print("Adding to root")
+                log.debug("Adding to root")
                 parent = Node(name=path.split('/')[1], directory=True)
                 session.add(parent)
                 session.commit()
+                dentry_cache.invalidate(path, None, parent.name)
                 return 0
 
             path_root = path.split('/')[:-1]
@@ -229,20 +928,19 @@ class Context(LoggingMixIn, Operations):
                 # I doubt EEXIST is the correct thing to be returning here.
                 return os.EEXIST
 
-            new_file = Node(name=path.split('/')[1], directory=True)
-            parent_node.children.append(new_file)
+            # Added by parent id, as appending to parent_node.children would load every sibling.
+            new_file = Node(parent_id=parent_node.id, name=path.split('/')[-1], directory=True)
+            session.add(new_file)
             session.commit()
-
-            block_path = helpers.blocks.get_block_root(path)
-
-            filesystem.make_directory(block_path)
+            dentry_cache.invalidate(path, parent_node.id, new_file.name)
+            dentry_cache.touch_node(parent_node.id)
 
             return new_file.id
 
         return os.EEXIST
 
     def create(self, path, mode):
-        print("Create called")
+        log.debug("Create called")
 
         if not Node.get_node_from_abs_path(path):
             if len(path.split('/')[:-1]) == 1:
@@ -250,10 +948,11 @@ class Context(LoggingMixIn, Operations):
                 #    /home.txt
                 # This would NOT include:
                 #    /home/home.txt
-                print("Adding to root")
+                log.debug("Adding to root")
                 new_file = Node(name=path.split('/')[1])
                 session.add(new_file)
                 session.commit()
+                dentry_cache.invalidate(path, None, new_file.name)
             else:
                 path_root = path.split('/')[:-1]
                 path_root = '/'.join(path_root)
@@ -265,116 +964,800 @@ class Context(LoggingMixIn, Operations):
                     # I doubt EEXIST is the correct thing to be returning here.
                     return os.EEXIST
 
-                new_file = Node(name=path.split('/')[-1], directory=False)
-                parent_node.children.append(new_file)
+                new_file = Node(parent_id=parent_node.id, name=path.split('/')[-1], directory=False)
+                session.add(new_file)
                 session.commit()
+                dentry_cache.invalidate(path, parent_node.id, new_file.name)
+                dentry_cache.touch_node(parent_node.id)
+
+            return self.open_handle(path, new_file)
 
-            block_path = helpers.blocks.get_block_root(path)
+        return os.EEXIST
 
-            print("Block path is: {}".format(block_path))
+    def open(self, path, flags):
+        node_to_open = Node.get_node_from_abs_path(path)
 
-            filesystem.make_directory(block_path)
+        if not node_to_open:
+            raise FuseOSError(ENOENT)
 
-            return new_file.id
+        return self.open_handle(path, node_to_open)
 
-        return os.EEXIST
+    def open_handle(self, path, node):
+        fh = next(self.file_handle_counter)
 
-    def open(self, path, flags):
-        # NOT a real fd - but will do for simple testing
-        return Node.get_node_from_abs_path(path).id
+        with self.handles_lock:
+            entry = self.write_buffers.get(node.id)
+            if entry is None:
+                write_buffer = helpers.writeback.WriteBuffer(BlockSize, self.write_buffer_size)
+                entry = self.write_buffers[node.id] = [write_buffer, 0]
+            entry[1] += 1
+
+        handle = FileHandle(path, node.id, entry[0])
+
+        # Read-ahead runs outside the database session, so it works from a snapshot of
+        # the stored blocks that is kept up to date by flush_handle.
+        handle.stored_blocks = node.get_stored_blocks()
+
+        if self.readahead_window:
+            handle.readahead = helpers.readahead.ReadAhead(
+                lambda index: self.prefetch_block(*handle.stored_blocks.get(index, (None, None))),
+                max_window=self.readahead_window,
+                submit=self.transfer_pool.submit if self.transfer_pool.workers else None)
+
+        with self.handles_lock:
+            self.file_handles[fh] = handle
+
+        return fh
+
+    def release(self, path, fh):
+        handle = self.file_handles.get(fh)
+
+        if handle is None:
+            return 0
+
+        try:
+            self.flush_handle(handle)
+        finally:
+            with self.handles_lock:
+                del self.file_handles[fh]
+
+            # The buffer goes once the last handle on the file is released, after flushing everything in it.
+            with self.file_lock(handle.node_id):
+                with self.handles_lock:
+                    entry = self.write_buffers[handle.node_id]
+                    entry[1] -= 1
+                    if not entry[1]:
+                        del self.write_buffers[handle.node_id]
+
+                if not entry[1]:
+                    handle.write_buffer.close()
+                    self.release_truncated_blocks(handle.node_id)
+
+            if handle.readahead:
+                handle.readahead.close()
+
+        return 0
 
     def write(self, path, data, offset, fh):
-        to_write_node = Node.get_node_from_abs_path(path)
-        block_path = helpers.blocks.get_block_root(path)
+        handle = self.file_handles.get(fh)
+
+        if handle is None:
+            # Not written through one of our handles, so write straight through.
+            fh = self.open(path, 0)
+            self.write(path, data, offset, fh)
+            self.release(path, fh)
+            return len(data)
+
+        log.debug("Buffering write of size %d at offset %d", len(data), offset)
+
+        # Reads apply buffered writes over whatever read-ahead fetched, so nothing needs invalidating here.
+        with self.file_lock(handle.node_id):
+            handle.write_buffer.write(offset, data)
+
+        return len(data)
 
-        block_size = BlockSize
-        first_block_for_to_write_data = int(math.ceil(offset / block_size))
-        first_block_offset = int(offset % block_size)
-        number_of_blocks = int(math.ceil((first_block_offset + block_size) / block_size))
+    def flush(self, path, fh):
+        if fh in self.file_handles:
+            self.flush_handle(self.file_handles[fh])
 
-        if offset == 0:
-            first_block_for_to_write_data = 1
+        return 0
+
+    def fsync(self, path, datasync, fh):
+        self.flush(path, fh)
+
+        # The rows the checkpoint makes durable may refer to blocks in the journal, so it is synced first.
+        if self.journal:
+            self.journal.sync()
+
+        # Commits are only synced at checkpoints, so an fsync forces one.
+        helpers.database.checkpoint(session.get_bind())
 
-        current_block = first_block_for_to_write_data
+        return 0
 
-        test = helpers.blocks.string_to_chunks(data, block_size)
+    #
+    # Upload every dirty block of the file, written through this handle or any other,
+    # once and record all of the resulting block metadata in a single transaction.
+    def flush_handle(self, handle):
+        with self.file_lock(handle.node_id):
+            pinned_hashes = []
 
-        print(list(test))
+            try:
+                self.write_back(handle, pinned_hashes)
+            finally:
+                self.unpin_hashes(pinned_hashes)
+
+    def unpin_hashes(self, pinned_hashes):
+        with self.block_lock:
+            for block_hash in pinned_hashes:
+                self.pinned_hashes[block_hash] -= 1
+                if self.pinned_hashes[block_hash] <= 0:
+                    del self.pinned_hashes[block_hash]
+
+    def write_back(self, handle, pinned_hashes):
+        if not handle.write_buffer.is_dirty():
+            return
+
+        # Another thread may have changed the node since this session loaded it.
+        node = session.query(Node).populate_existing().get(handle.node_id)
+
+        # A file that has been chunked stays chunked, whatever the mount uses for new files.
+        if self.chunker or node.chunked:
+            superseded_hashes, failed = self.write_back_chunks(handle, node, pinned_hashes)
+        else:
+            superseded_hashes, failed = self.write_back_blocks(handle, node, pinned_hashes)
+
+        session.commit()
+        dentry_cache.touch_node(node.id)
+
+        for block_hash in superseded_hashes:
+            self.release_stored_block(block_hash)
+
+        if failed:
+            raise FuseOSError(EIO)
+
+    #
+    # Write back a file split into BlockSize blocks, replacing every dirty block in place.
+    # Returns the hashes of the blocks that were replaced and whether any block failed to load or upload.
+    def write_back_blocks(self, handle, node, pinned_hashes):
+        write_buffer = handle.write_buffer
+        superseded_hashes = []
+        failed = False
+
+        dirty_indexes = write_buffer.dirty_indexes()
+        batch_size = max(self.transfer_pool.workers * 2, 1)
+
+        for batch_start in range(0, len(dirty_indexes), batch_size):
+            batch = []
+            contents = {}
+
+            for index in dirty_indexes[batch_start:batch_start + batch_size]:
+                block_instance = node.get_block(index)
+                stored_size = block_instance.size if block_instance else 0
+
+                try:
+                    new_block_contents = write_buffer.merge(index, stored_size,
+                                                            lambda: self.read_stored_block(node, index))
+                except FuseOSError:
+                    # The stored block could not be read to merge with, so the block stays dirty for a later flush.
+                    failed = True
+                    continue
 
-        for position, data_block in enumerate(helpers.blocks.string_to_chunks(data, block_size, block_size - first_block_offset)):
-            if (position == 0):
-                # This is the first block that we are writing to
-                bytes_to_write = block_size - first_block_offset
-                offset_for_block = first_block_offset
-            elif (position == number_of_blocks):
-                # This is the last block that we are writing to
-                bytes_to_write = block_size - (block_size - first_block_offset)
-                offset_for_block = 0
+                if new_block_contents.count(b"\0") == len(new_block_contents):
+                    # A block of zeros is left as a hole rather than stored.
+                    if block_instance is not None:
+                        superseded_hashes.append(block_instance.hash)
+                        session.delete(block_instance)
+                        node.block_count = (node.block_count or 0) - 1
+
+                    node.size = max(node.size or 0, (index - 1) * BlockSize + len(new_block_contents))
+                    write_buffer.discard(index)
+
+                    for other_handle in self.handles_for_node(handle.node_id):
+                        other_handle.stored_blocks.pop(index, None)
+                    self.invalidate_readahead(handle.node_id, [index])
+                    continue
+
+                data_hash = hashlib.md5()
+                data_hash.update(new_block_contents)
+                block_hash = data_hash.hexdigest()
+
+                contents[block_hash] = new_block_contents
+                batch.append((index, block_instance, new_block_contents, block_hash))
+
+            stored_objects = self.store_blocks(contents, pinned_hashes)
+
+            for index, block_instance, new_block_contents, block_hash in batch:
+                if not stored_objects[block_hash]:
+                    # Keep the block dirty so that a later flush can try again.
+                    failed = True
+                    continue
+
+                codec, stored_size, stripe = stored_objects[block_hash]
+
+                if block_instance is None:
+                    block_instance = Block(position=index, file_offset=(index - 1) * BlockSize, size=0)
+                    node.blocks.append(block_instance)
+                    node.block_count = (node.block_count or 0) + 1
+                elif block_instance.hash != block_hash:
+                    superseded_hashes.append(block_instance.hash)
+
+                # Blocks before this one may be holes, so the size is where the last block ends.
+                node.size = max(node.size or 0, block_instance.file_offset + len(new_block_contents))
+                block_instance.size = len(new_block_contents)
+                block_instance.hash = block_hash
+                block_instance.codec = codec
+                block_instance.stored_size = stored_size
+                block_instance.stripe = stripe
+
+                write_buffer.discard(index)
+
+                for other_handle in self.handles_for_node(handle.node_id):
+                    other_handle.stored_blocks[index] = (block_hash, codec)
+                self.invalidate_readahead(handle.node_id, [index])
+
+        return superseded_hashes, failed
+
+    #
+    # Write back a file split into content-defined chunks. Each dirty range is widened
+    # to the stored chunks it touches, and that part of the file is read back with the
+    # buffered writes applied and chunked again. Chunks outside it are left alone and
+    # unchanged content inside it cuts into the same chunks, which are already stored.
+    def write_back_chunks(self, handle, node, pinned_hashes):
+        write_buffer = handle.write_buffer
+        chunker = self.chunker or helpers.chunking.Chunker()
+        superseded_hashes = []
+        failed = False
+
+        regions = []
+        for start, end in write_buffer.dirty_ranges():
+            overlapping_blocks = node.get_blocks_in_range(start, end - start)
+
+            if overlapping_blocks:
+                start = min(start, overlapping_blocks[0].file_offset)
+                end = max(end, overlapping_blocks[-1].file_offset + overlapping_blocks[-1].size)
+
+            if regions and regions[-1][1] >= start:
+                regions[-1] = (regions[-1][0], max(regions[-1][1], end))
             else:
-                bytes_to_write = block_size
-                offset_for_block = 0
+                regions.append((start, end))
 
-            data_hash = hashlib.md5()
-            data_hash.update(data_block)
+        batch_size = max(self.transfer_pool.workers * 2, 1)
 
-            current_block = first_block_for_to_write_data + position
+        # Working from the end of the file back means renumbering the blocks after a
+        # region never moves a region that is still to be done.
+        for start, end in reversed(regions):
+            # (offset, size, hash) of each new chunk.
+            chunks = []
+            contents = {}
+            stored_objects = {}
+            chunk_offset = start
 
-            block_instance = Block()
-            block_instance.size = len(data_block)
-            block_instance.hash = data_hash.hexdigest()
-            block_instance.position = position
+            try:
+                for chunk in chunker.chunks(self.iterate_bytes(handle.path, node, start, end)):
+                    block_hash = hashlib.md5(chunk).hexdigest()
+                    chunks.append((chunk_offset, len(chunk), block_hash))
+                    chunk_offset += len(chunk)
+                    contents[block_hash] = chunk
+
+                    if len(contents) >= batch_size:
+                        stored_objects.update(self.store_blocks(contents, pinned_hashes))
+                        contents = {}
+            except FuseOSError:
+                # A stored chunk of the region could not be read back, so it is left as it is.
+                failed = True
+                continue
 
-            session.add(block_instance)
-            to_write_node.blocks.append(block_instance)
-            session.commit()
+            stored_objects.update(self.store_blocks(contents, pinned_hashes))
+
+            if not all(stored_objects[block_hash] for chunk_offset, chunk_size, block_hash in chunks):
+                failed = True
+                continue
+
+            previous_block = session.query(Block.position).filter(Block.node == node.id, Block.file_offset < start)\
+                .order_by(Block.file_offset.desc(), Block.id.desc()).first()
+            previous_position = previous_block.position if previous_block else 0
+            old_blocks = node.get_blocks_in_range(start, end - start)
+            last_position = old_blocks[-1].position if old_blocks else previous_position
+
+            for block in session.query(Block).filter(Block.node == node.id, Block.position > previous_position,
+                                                     Block.position <= last_position):
+                superseded_hashes.append(block.hash)
+                session.delete(block)
+
+            shift = len(chunks) - (last_position - previous_position)
+            if shift:
+                session.query(Block).filter(Block.node == node.id, Block.position > last_position)\
+                    .update({Block.position: Block.position + shift}, synchronize_session='evaluate')
+
+            for number, (chunk_offset, chunk_size, block_hash) in enumerate(chunks):
+                codec, stored_size, stripe = stored_objects[block_hash]
+                node.blocks.append(Block(position=previous_position + 1 + number, file_offset=chunk_offset,
+                                         size=chunk_size, hash=block_hash, codec=codec, stored_size=stored_size,
+                                         stripe=stripe))
+
+            node.block_count = (node.block_count or 0) + shift
+            if chunks:
+                node.size = max(node.size or 0, chunks[-1][0] + chunks[-1][1])
+
+            # The regions still to be done are read with plain SQL, which does not autoflush.
+            session.flush()
+
+        node.chunked = True
+
+        if not failed:
+            for index in write_buffer.dirty_indexes():
+                write_buffer.discard(index)
+
+        # Positions have moved, so read-ahead has to start again from the new layout.
+        stored_blocks = node.get_stored_blocks()
+        for other_handle in self.handles_for_node(handle.node_id):
+            other_handle.stored_blocks = dict(stored_blocks)
+            if other_handle.readahead:
+                other_handle.readahead.reset()
+
+        return superseded_hashes, failed
+
+    #
+    # Make sure the contents of every block in contents (hash -> bytes) are stored,
+    # uploading the ones that are not stored yet concurrently, once per distinct hash.
+    # Returns hash -> (codec, stored size, stripe), or None for a block whose upload failed.
+    def store_blocks(self, contents, pinned_hashes):
+        stored_objects = {}
+        upload_hashes = []
+
+        # Blocks recorded by an earlier batch of this flush must be visible to find_stored.
+        session.flush()
+
+        for block_hash in contents:
+            # Pinning the hash stops release_stored_block deleting it before this flush commits.
+            with self.block_lock:
+                self.pinned_hashes[block_hash] += 1
+                pinned_hashes.append(block_hash)
+                self.pending_deletes.discard(block_hash)
+
+                while block_hash in self.deleting:
+                    self.deleted.wait()
+
+                stored_object = Block.find_stored(block_hash)
+                if stored_object is None and block_hash in self.truncated_blocks:
+                    stored_object = self.truncated_blocks[block_hash][0]
+
+            if stored_object:
+                log.debug("Block %s is already stored, skipping upload", block_hash)
+                stored_objects[block_hash] = tuple(stored_object)
+            else:
+                upload_hashes.append(block_hash)
 
-            print("Writing data of size {} to block {} at offset {}".format(len(data_block), current_block,
-                                                                               offset_for_block))
+        stored_objects.update(zip(upload_hashes, self.transfer_pool.map(
+            lambda block_hash: self.upload_block(block_hash, contents[block_hash]), upload_hashes)))
 
-            current_block_contents = filesystem.readFile(block_path + str(current_block))
-            if not current_block_contents:
-                current_block_contents = ""
+        # The rows about to be committed must not outlive a crash that the journalled blocks they
+        # refer to do not, and any SQLite checkpoint can make them durable.
+        if self.journal:
+            self.journal.sync()
 
-            new_block_contents = current_block_contents[:offset_for_block] + data_block
+        if self.block_cache:
+            for block_hash in contents:
+                if stored_objects[block_hash]:
+                    self.block_cache.put(helpers.blocks.get_block_name(block_hash), contents[block_hash])
+
+        return stored_objects
+
+    #
+    # Compress and upload a block, returning (codec, stored size, stripe) or None if it failed.
+    # Failed uploads are retried by the drivers.scheduled.ScheduledDriver in front of the driver.
+    # With a journal the block counts as stored once it is in the journal, and a striped
+    # driver is told now which stripe it will be uploaded to.
+    def upload_block(self, block_hash, contents):
+        codec, contents = helpers.compression.compress(contents, self.compression)
+        block_name = helpers.blocks.get_block_name(block_hash)
+
+        if self.journal:
+            log.debug("Journalling data of size %d for block %s with codec %s", len(contents), block_hash, codec)
+
+            # Placed first, as a journal thread may upload the block as soon as it is appended.
+            stripe = filesystem.place(block_name) if hasattr(filesystem, 'place') else None
+
+            try:
+                self.journal.append(block_name, contents)
+            except (IOError, OSError):
+                log.exception("Could not add block %s to the journal", block_hash)
+                return None
+
+            return codec, len(contents), stripe
+
+        log.debug("Writing data of size %d to block %s with codec %s", len(contents), block_hash, codec)
+
+        if not self.send_block(block_name, contents):
+            return None
+
+        # A striped driver reports where the block went, so it can be found after a remount.
+        stripe = filesystem.get_stripe(block_name) if hasattr(filesystem, 'get_stripe') else None
+
+        return codec, len(contents), stripe
+
+    #
+    # Write stored contents to the driver, making the block directory first if need be.
+    # Called from transfer and journal threads.
+    def send_block(self, block_name, contents):
+        block_directory = helpers.blocks.get_block_directory(block_name.rsplit('/', 1)[-1])
+
+        if block_directory not in self.block_directories:
+            filesystem.make_directory(block_directory)
+            self.block_directories.add(block_directory)
+
+        return filesystem.write_file(block_name, contents)
+
+    #
+    # Delete a stored block once no Block row refers to its contents any more, returning
+    # whether it will be. The driver is called by delete_pool, or by this thread with wait.
+    def release_stored_block(self, block_hash, wait=False):
+        with self.block_lock:
+            if self.pinned_hashes[block_hash] or Block.count_references(block_hash) > 0:
+                return False
 
-            write_success = False
-            number_of_retries_left = 3
+            self.pending_deletes.add(block_hash)
 
-            while not write_success and number_of_retries_left > 0:
-                if not filesystem.write_file(block_path + str(current_block), new_block_contents):
-                    number_of_retries_left -= 1
-                    write_success = False
+        if wait:
+            self.delete_stored_block(block_hash)
+        else:
+            self.delete_pool.submit(self.delete_stored_block, block_hash)
+
+        return True
+
+    #
+    # The garbage collector deletes blocks itself, so that its pace is the pace of the deletes.
+    def collect_stored_block(self, block_hash):
+        return self.release_stored_block(block_hash, wait=True)
+
+    def delete_stored_block(self, block_hash):
+        block_name = helpers.blocks.get_block_name(block_hash)
+
+        with self.block_lock:
+            # Stored again since it was released.
+            if block_hash not in self.pending_deletes:
+                self.deleted.notify_all()
+                return
+
+            self.pending_deletes.discard(block_hash)
+            self.deleting.add(block_hash)
+
+        try:
+            log.debug("Deleting unreferenced block %s", block_hash)
+
+            # A block that never left the journal has nothing to delete on the driver, but
+            # one being uploaded right now does once it is there.
+            if not (self.journal and self.journal.discard(block_name)):
+                filesystem.delete_file(block_name)
+
+            if self.block_cache:
+                self.block_cache.invalidate(block_name)
+        finally:
+            with self.block_lock:
+                self.deleting.discard(block_hash)
+                self.deleted.notify_all()
+
+    #
+    # Return the names stored in the block directory for a hash prefix, or False.
+    def list_block_directory(self, prefix):
+        return filesystem.list_files(helpers.blocks.get_block_directory(prefix))
+
+    #
+    # Delete the Block rows nothing reads any more: those of files that are gone, and
+    # older rows for a position that has a newer one, which get_block passes over.
+    # Returns how many there were and the hashes they referred to, for the stored
+    # blocks to be released. With dry_run they are only counted.
+    def compact_blocks(self, dry_run=False):
+        block_hashes = set()
+        detached_blocks = session.execute(FIND_DETACHED_BLOCKS).fetchall()
+        compacted_rows = len(detached_blocks)
+
+        if not dry_run:
+            self.delete_block_rows(detached_blocks, block_hashes)
+            session.commit()
+
+        for node_id, in session.execute(FIND_NODES_WITH_SUPERSEDED_BLOCKS).fetchall():
+            # A flush of the file in between could have replaced the rows, so they are found again under its lock.
+            with self.file_lock(node_id):
+                superseded_blocks = session.execute(FIND_SUPERSEDED_BLOCKS, dict(node=node_id)).fetchall()
+                compacted_rows += len(superseded_blocks)
+
+                if dry_run or not superseded_blocks:
                     continue
-                write_success = True
 
-            # As yet undecided what to do in the case that all uploads failed
-            # Best guess would be to return an I/O error - that seems to match the actual error fairly well.
+                node = session.query(Node).populate_existing().get(node_id)
+                self.delete_block_rows(superseded_blocks, block_hashes)
+                node.block_count = max((node.block_count or 0) - len(superseded_blocks), 0)
+                session.commit()
 
-        return len(data)
+            dentry_cache.touch_node(node_id)
 
+        return compacted_rows, block_hashes
 
-if __name__ == '__main__':
-    if len(argv) != 2:
-        print('usage: %s <mountpoint>' % argv[0])
-        exit(1)
+    def delete_block_rows(self, blocks, block_hashes):
+        blocks = list(blocks)
+
+        # SQLite limits how many parameters a statement can have.
+        for start in range(0, len(blocks), 500):
+            batch = blocks[start:start + 500]
+            session.query(Block).filter(Block.id.in_([block.id for block in batch]))\
+                .delete(synchronize_session=False)
+            block_hashes.update(block.hash for block in batch if block.hash)
 
-    logging.basicConfig(level=logging.DEBUG)
+    #
+    # Handles are found by node rather than path, as a rename can change the path of an open file.
+    def handles_for_node(self, node_id):
+        with self.handles_lock:
+            return [handle for handle in self.file_handles.values() if handle.node_id == node_id]
 
-    engine = create_engine('sqlite:///nodes.db')
-    sessionMaker = sessionmaker()
-    sessionMaker.configure(bind=engine)
+    def invalidate_readahead(self, node_id, indexes):
+        for handle in self.handles_for_node(node_id):
+            if handle.readahead:
+                for index in indexes:
+                    handle.readahead.invalidate(index)
+
+
+#
+# Open the node database, creating or upgrading its schema. Nothing here reads every
+# node, unless a check is asked for or an upgrade needs one, so opening takes the
+# same time however many files there are.
+def open_database(database_url, check=False, metrics=None, driver=None, migrate=False):
+    global session
+
+    # Connections are pooled rather than opened for every transaction. A connection is
+    # only used by one thread at a time, but not always the thread that created it.
+    engine = create_engine(database_url, poolclass=QueuePool, pool_size=16, max_overflow=-1,
+                           connect_args=dict(check_same_thread=False))
+    helpers.database.configure_sqlite(engine)
+
+    if metrics:
+        metrics.watch_engine(engine)
+
+    created = 'node' not in inspect(engine).get_table_names()
     Base.metadata.create_all(engine)
-    session = sessionMaker()
+    added_columns = helpers.database.upgrade_schema(engine, Base.metadata)
 
-    print("Listing all nodes")
-    for node in session.query(Node):
-        print("Node: {}".format(node.name))
+    # A new database holds nothing to upgrade.
+    if created:
+        helpers.database.set_data_version(engine, DataVersion)
 
-    print("Testing drivers")
-    driverImport = importlib.import_module("drivers.dropbox_driver", __name__)
+    # Each FUSE worker thread gets its own session.
+    session = scoped_session(sessionmaker(bind=engine))
 
-    global filesystem
-    filesystem = driverImport.drivers.dropbox_driver.DropboxDriver()
-    filesystem.init()
+    if 'block.file_offset' in added_columns:
+        print("Recording block offsets")
+        Block.fill_offsets()
+
+    # A database from before the data version was kept may hold files whose blocks are still named
+    # after their path. Those are only found by looking, which needs the driver, and the version is
+    # only bumped once every one of them has been moved, so a mount that fails part way is not the last.
+    migrated = None
+    if driver is not None and (migrate or helpers.database.get_data_version(engine) < DataVersion):
+        print("Migrating blocks named after their file")
+        migrated = migrate_path_named_blocks(driver)
+        if migrated is None:
+            raise RuntimeError('Could not migrate the blocks of every file, refusing to mount')
+        print("Migrated {} files".format(migrated))
+
+    if check or migrated is not None or 'node.block_count' in added_columns:
+        print("Checking file sizes")
+        print("Fixed {} nodes".format(len(Node.check_sizes())))
+
+    if migrated is not None:
+        helpers.database.set_data_version(engine, DataVersion)
+
+    return engine
 
-    fuse = FUSE(Context(), argv[1], ro=False, foreground=True, nothreads=True, daemon_timeout=10000)
+
+#
+# Store the blocks of files written before blocks were stored by content under the md5 of
+# their contents, and replace the rows of those files, which did not describe them. Files
+# with nothing in their old block directory are left alone. Returns how many files were
+# migrated, or None if a block could not be copied, leaving that file as it was.
+def migrate_path_named_blocks(driver):
+    nodes = dict((node.id, node) for node in session.query(Node))
+    migrated = 0
+
+    for node in nodes.values():
+        if node.directory:
+            continue
+
+        names = [node.name]
+        parent = nodes.get(node.parent_id)
+        while parent is not None:
+            names.append(parent.name)
+            parent = nodes.get(parent.parent_id)
+
+        path = '/' + '/'.join(reversed(names))
+        old_directory = helpers.blocks.get_path_block_directory(path)
+        indexes = sorted(int(name) for name in driver.list_files(old_directory) or [] if name.isdigit())
+        if not indexes:
+            continue
+
+        # Block n held the bytes from (n - 1) * BlockSize.
+        blocks = []
+        for index in indexes:
+            contents = driver.readFile(old_directory + str(index))
+            if contents is False or contents is None:
+                log.error("Could not read block %d of %s", index, path)
+                return None
+
+            if not contents:
+                continue
+
+            block_hash = hashlib.md5(contents).hexdigest()
+            block_name = helpers.blocks.get_block_name(block_hash)
+            stored = Block.find_stored(block_hash)
+            stripe = stored.stripe if stored else None
+
+            if stored is None or stored.codec != helpers.compression.RAW:
+                driver.make_directory(helpers.blocks.get_block_directory(block_hash))
+                if not driver.write_file(block_name, contents):
+                    log.error("Could not store block %d of %s", index, path)
+                    return None
+
+                stripe = driver.get_stripe(block_name) if hasattr(driver, 'get_stripe') else None
+
+            blocks.append(Block(node=node.id, position=index, file_offset=(index - 1) * BlockSize,
+                                size=len(contents), hash=block_hash, codec=helpers.compression.RAW,
+                                stored_size=len(contents), stripe=stripe))
+
+        session.query(Block).filter(Block.node == node.id).delete(synchronize_session=False)
+        session.add_all(blocks)
+        node.size = max([block.file_offset + block.size for block in blocks] or [0])
+        node.block_count = len(blocks)
+        session.commit()
+        migrated += 1
+
+        # Only once the new rows are committed is nothing lost if these go.
+        for index in indexes:
+            driver.delete_file(old_directory + str(index))
+        driver.delete_directory(old_directory)
+        driver.delete_directory(old_directory.rsplit('/', 2)[0] + '/')
+
+    return migrated
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mount a cloud-fuse filesystem.')
+    parser.add_argument('mountpoint', nargs='?')
+    parser.add_argument('--check', action='store_true',
+                        help='recompute stored file sizes and block counts, then exit')
+    parser.add_argument('--migrate-blocks', action='store_true',
+                        help='move blocks still named after their file to where they are stored by content')
+    parser.add_argument('--cache-dir', default='block-cache',
+                        help='directory used for the local block cache')
+    parser.add_argument('--cache-size', type=int, default=512,
+                        help='block cache budget in MiB, 0 disables the cache')
+    parser.add_argument('--readahead', type=int, default=32,
+                        help='maximum number of blocks to prefetch for sequential reads, 0 disables read-ahead')
+    parser.add_argument('--write-buffer-size', type=int, default=64,
+                        help='MiB of dirty blocks kept in memory per open file before spilling to disk')
+    parser.add_argument('--journal-dir',
+                        help='directory of a local journal that writes complete in, to be uploaded in the background')
+    parser.add_argument('--journal-size', type=int, default=1024,
+                        help='MiB of blocks the journal holds before writes wait for uploads')
+    parser.add_argument('--gc-interval', type=float, default=0,
+                        help='hours between looking for stored blocks that nothing refers to, and deleting those '
+                             'found twice in a row, 0 to never look')
+    parser.add_argument('--gc-rate', type=float, default=2,
+                        help='most calls per second the garbage collector makes to the provider')
+    parser.add_argument('--gc-dry-run', action='store_true',
+                        help='only report what the garbage collector would delete')
+    parser.add_argument('--collect-garbage', action='store_true',
+                        help='look for stored blocks that nothing refers to, delete those the last look found too, '
+                             'print a report and exit')
+    parser.add_argument('--compression', default=helpers.compression.RAW,
+                        choices=helpers.compression.available_codecs(),
+                        help='codec used to compress new blocks, blocks that do not compress are stored raw')
+    parser.add_argument('--chunking', default='fixed', choices=['fixed', 'cdc'],
+                        help='split new writes into fixed size blocks or content-defined chunks')
+    parser.add_argument('--chunk-min', type=int, default=16,
+                        help='smallest content-defined chunk in KiB')
+    parser.add_argument('--chunk-avg', type=int, default=64,
+                        help='average content-defined chunk in KiB')
+    parser.add_argument('--chunk-max', type=int, default=256,
+                        help='largest content-defined chunk in KiB')
+    parser.add_argument('--transfers', type=int,
+                        help='number of block transfers, and connections to each provider, to use at once')
+    parser.add_argument('--drivers', nargs='+', default=['dropbox'], choices=['dropbox', 'filesystem'],
+                        help='store blocks on these providers, striped across them when there is more than one')
+    parser.add_argument('--filesystem-root', default=drivers.filesystem.DEFAULT_ROOT,
+                        help='directory the filesystem driver stores blocks under')
+    parser.add_argument('--filesystem-mmap', action='store_true',
+                        help='read blocks stored by the filesystem driver through memory maps')
+    parser.add_argument('--replicas', type=int, default=1,
+                        help='write every block to this many of the drivers and hedge reads across them')
+    parser.add_argument('--request-rate', type=float, default=0,
+                        help='most calls per second to make to each provider, 0 to only slow down when it asks')
+    parser.add_argument('--placement', default=drivers.striped.ROUND_ROBIN,
+                        choices=[drivers.striped.ROUND_ROBIN, drivers.striped.HASH],
+                        help='how new blocks are spread over the drivers when striping')
+    parser.add_argument('--single-threaded', action='store_true',
+                        help='handle one FUSE request at a time')
+    parser.add_argument('--log-level', default='info', choices=['debug', 'info', 'warning', 'error'],
+                        help='debug logs every FUSE operation, which slows the filesystem down')
+    parser.add_argument('--trace',
+                        help='record every FUSE operation to this file, for replay.py')
+    parser.add_argument('--stats-socket',
+                        help='unix socket that serves operation, driver and cache statistics as JSON')
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, arguments.log_level.upper()))
+
+    metrics = helpers.metrics.Metrics()
+
+    if arguments.check:
+        open_database('sqlite:///nodes.db', True, metrics)
+        exit(0)
+
+    if not arguments.mountpoint and not arguments.collect_garbage:
+        parser.error('a mountpoint is required')
+
+    if arguments.replicas < 1:
+        parser.error('--replicas must be at least 1')
+
+    if arguments.replicas > len(arguments.drivers):
+        parser.error('--replicas {} needs at least as many --drivers, {} given'.format(
+            arguments.replicas, len(arguments.drivers)))
+
+    transfers = arguments.transfers if arguments.transfers is not None else 8
+
+    def load_driver(name):
+        if name == 'filesystem':
+            return drivers.filesystem.FileSystem(arguments.filesystem_root, use_mmap=arguments.filesystem_mmap)
+
+        return importlib.import_module("drivers.dropbox_driver").DropboxDriver(connections=transfers)
+
+    # Importing and authenticating a driver can take seconds, so it happens in the
+    # background while the filesystem is mounted. Calls made before then wait for it.
+    driver_names = dict(dropbox='DropboxDriver', filesystem='FileSystem')
+    backends = []
+    for number, name in enumerate(arguments.drivers):
+        metered_name = driver_names[name]
+        if len(arguments.drivers) > 1:
+            metered_name = '{}.{}'.format(metered_name, number)
+
+        backends.append(drivers.scheduled.ScheduledDriver(drivers.metered.MeteredDriver(
+            drivers.deferred.DeferredDriver(lambda name=name: load_driver(name), transfers), metrics, metered_name),
+            rate=arguments.request_rate or None, metrics=metrics))
+
+    global filesystem
+    if len(backends) == 1:
+        filesystem = backends[0]
+    elif arguments.replicas > 1:
+        filesystem = drivers.replicated.ReplicatedDriver(backends, arguments.replicas)
+    else:
+        filesystem = drivers.striped.StripedDriver(backends, arguments.placement, locate=Block.find_stripe)
+
+    # Opened once there is a driver, as an upgrade may need to move blocks.
+    engine = open_database('sqlite:///nodes.db', metrics=metrics, driver=filesystem, migrate=arguments.migrate_blocks)
+
+    block_cache = None
+    if arguments.cache_size > 0:
+        block_cache = helpers.cache.BlockCache(arguments.cache_dir, arguments.cache_size * 1024 * 1024)
+
+    chunker = None
+    if arguments.chunking == 'cdc':
+        chunker = helpers.chunking.Chunker(arguments.chunk_min * 1024, arguments.chunk_avg * 1024,
+                                           arguments.chunk_max * 1024)
+
+    context = Context(block_cache=block_cache, readahead_window=arguments.readahead,
+                      write_buffer_size=arguments.write_buffer_size * 1024 * 1024,
+                      transfer_pool=helpers.transfer.TransferPool(transfers * len(backends)),
+                      compression=arguments.compression, chunker=chunker, metrics=metrics,
+                      trace=helpers.trace.TraceRecorder(arguments.trace) if arguments.trace else None,
+                      journal_directory=arguments.journal_dir, journal_size=arguments.journal_size * 1024 * 1024,
+                      collect_interval=0 if arguments.collect_garbage else arguments.gc_interval * 60 * 60,
+                      collect_rate=arguments.gc_rate, collect_dry_run=arguments.gc_dry_run)
+
+    if arguments.collect_garbage:
+        print(json.dumps(context.collector.run(), indent=2, sort_keys=True))
+        context.destroy('/')
+        exit(0)
+
+    if arguments.stats_socket:
+        helpers.metrics.MetricsServer(context.stats, arguments.stats_socket)
+
+    fuse = FUSE(context, arguments.mountpoint, ro=False, foreground=True,
+                nothreads=arguments.single_threaded, daemon_timeout=10000)
@@ -0,0 +1,75 @@
+#
+# @file  deferred.py
+#
+# @brief Creates and authenticates a driver in the background, so that mounting does not wait for
+#        the provider. Calls made before the driver is ready wait for it.
+#
+
+import logging
+import threading
+
+log = logging.getLogger('cloud-fuse')
+
+
+class DeferredDriver:
+    # load_driver() returns a new driver, init() is called on it once it has been created.
+    # concurrency is reported until the driver is ready, as transfer pools are sized at mount time.
+    def __init__(self, load_driver, concurrency=4):
+        self.load_driver = load_driver
+        self.concurrency = concurrency
+        self.supports_read_range = False
+
+        self.driver = None
+        self.ready = threading.Event()
+
+        self.thread = threading.Thread(target=self.load)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def load(self):
+        try:
+            driver = self.load_driver()
+            driver.init()
+
+            self.concurrency = driver.concurrency
+            self.supports_read_range = driver.supports_read_range
+            self.driver = driver
+        except Exception:
+            log.exception("Could not start the driver")
+        finally:
+            self.ready.set()
+
+    #
+    # Wait for the driver and call it. Every call fails if the driver could not be started.
+    def call(self, call, *arguments):
+        self.ready.wait()
+
+        if self.driver is None:
+            return False
+
+        return getattr(self.driver, call)(*arguments)
+
+    def write_file(self, fileName, fileContents):
+        return self.call('write_file', fileName, fileContents)
+
+    def readFile(self, fileName):
+        return self.call('readFile', fileName)
+
+    def read_range(self, fileName, offset, length):
+        return self.call('read_range', fileName, offset, length)
+
+    def delete_file(self, fileName):
+        return self.call('delete_file', fileName)
+
+    def make_directory(self, directoryName):
+        return self.call('make_directory', directoryName)
+
+    def delete_directory(self, directoryName):
+        return self.call('delete_directory', directoryName)
+
+    def list_files(self, directoryName):
+        return self.call('list_files', directoryName)
+
+    # Loading has already started.
+    def init(self):
+        return True
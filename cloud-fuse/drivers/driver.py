@@ -1,10 +1,34 @@
+#
+# Raised by a driver when the provider asks for fewer calls. retry_after is the number
+# of seconds it asked to wait for, or None if it did not say.
+class RateLimited(Exception):
+    def __init__(self, retry_after=None):
+        Exception.__init__(self, 'rate limited, retry after {} seconds'.format(retry_after))
+        self.retry_after = retry_after
+
+
+#
+# Raised by a driver when a call failed in a way that making it again may fix, such as a
+# timeout or a server error. Failures that will not go away are reported by returning False.
+class TransientError(Exception):
+    pass
+
+
 class Driver:
+    # How many block transfers the provider can usefully run at the same time.
+    concurrency = 4
+    # Whether read_range can fetch part of a file without downloading all of it.
+    supports_read_range = False
+
     def write_file(self, fileName, fileContents):
         return False
 
     def delete_file(self, fileName):
         return False
 
+    def read_range(self, fileName, offset, length):
+        return False
+
     def make_directory(self, directoryName):
         return False
 
@@ -1,40 +1,76 @@
+import logging
+
 import dropbox
+import dropbox.exceptions
 import dropbox.files
+import requests
 
 import drivers.driver
+import drivers.pool
+
+log = logging.getLogger('cloud-fuse')
+
+access_token = "wB4qXMwTafAAAAAAAAAAyxiCpOxsYLuvCyYMRZTT_RZDGXHdiqiqq1CJZ2XegDsA"
 
 
 class DropboxDriver(drivers.driver.Driver):
+    def __init__(self, connections=8):
+        self.concurrency = connections
+        # Retrying is left to drivers.scheduled, which knows about every call being made.
+        self.pool = drivers.pool.ConnectionPool(
+            lambda: dropbox.Dropbox(access_token, max_retries_on_error=0, max_retries_on_rate_limit=0), connections)
+
+    #
+    # Run request(client). A rate limit or a failure that may go away is raised for the
+    # caller to retry, anything else, such as a missing file, returns False.
+    def request(self, request):
+        try:
+            with self.pool.connection() as dbx:
+                return request(dbx)
+        except dropbox.exceptions.RateLimitError as error:
+            raise drivers.driver.RateLimited(error.backoff)
+        except (dropbox.exceptions.InternalServerError, requests.exceptions.RequestException) as error:
+            raise drivers.driver.TransientError(str(error))
+        except dropbox.exceptions.DropboxException as error:
+            log.debug("Dropbox call failed: %s", error)
+            return False
+
     def init(self):
-        global dbx
-        dbx = dropbox.Dropbox("wB4qXMwTafAAAAAAAAAAyxiCpOxsYLuvCyYMRZTT_RZDGXHdiqiqq1CJZ2XegDsA")
-        dbx.users_get_current_account()
+        return self.request(lambda dbx: dbx.users_get_current_account()) is not False
 
     def delete_directory(self, directory_name):
-        dbx.files_delete(directory_name)
+        return self.request(lambda dbx: dbx.files_delete(directory_name)) is not False
+
+    def delete_file(self, fileName):
+        return self.request(lambda dbx: dbx.files_delete(fileName)) is not False
 
     def write_file(self, fileName, fileContents):
-        try:
-            dbx.files_upload(fileContents, fileName, dropbox.files.WriteMode.overwrite, mute=True)
-        except:
-            return False
+        return self.request(lambda dbx: dbx.files_upload(fileContents, fileName, dropbox.files.WriteMode.overwrite,
+                                                         mute=True)) is not False
 
     def readFile(self, fileName):
-        try:
-            metadata, result = dbx.files_download(fileName)
-            return result.content
-        except:
+        result = self.request(lambda dbx: dbx.files_download(fileName))
+
+        if result is False:
             return False
 
+        metadata, response = result
+        return response.content
+
     def make_directory(self, directoryName):
-        try:
-            dbx.files_create_folder(directoryName)
-            return True
-        except:
-            return False
+        return self.request(lambda dbx: dbx.files_create_folder(directoryName)) is not False
 
+    #
+    # Return the names in a folder, following the cursor over every page of a large one.
     def list_files(self, directory_name):
-        try:
-            return dbx.files_list_folder(directory_name)
-        except:
-            return False
\ No newline at end of file
+        def list_folder(dbx):
+            result = dbx.files_list_folder(directory_name)
+            names = [entry.name for entry in result.entries]
+
+            while result.has_more:
+                result = dbx.files_list_folder_continue(result.cursor)
+                names.extend(entry.name for entry in result.entries)
+
+            return names
+
+        return self.request(list_folder)
@@ -1,31 +1,231 @@
-import drivers.driver
+#
+# @file  filesystem.py
+#
+# @brief Stores objects as files under a local directory, which may be a NAS mount. Files
+#        are replaced atomically, and the files read from are kept open so that ranged
+#        reads are a single pread, or a slice of a memory map.
+#
+
+import itertools
+import mmap
 import os
+import threading
+import uuid
+
+import drivers.driver
+
+DEFAULT_ROOT = 'data12'
+# Files being written are named after the file they replace with this suffix, and are not listed.
+TEMPORARY_SUFFIX = '.tmp'
+
+
+class OpenFile:
+    def __init__(self, path, use_mmap):
+        self.fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        self.size = os.fstat(self.fd).st_size
+        self.mapping = None
+        # Calls using the file, which is only closed once it is retired and the last of them is done.
+        self.users = 0
+        self.retired = False
+        self.used = 0
+        # Without os.pread, as on Python 2, a seek and the read after it must not be interleaved.
+        self.lock = threading.Lock()
+
+        try:
+            # Empty files cannot be mapped.
+            if use_mmap and self.size:
+                self.mapping = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            self.mapping = None
+
+    def read_at(self, offset, length):
+        if hasattr(os, 'pread'):
+            return os.pread(self.fd, length, offset)
+
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, length)
+
+    #
+    # Return up to length bytes from offset, fewer only at the end of the file.
+    def read(self, offset, length):
+        length = max(min(length, self.size - offset), 0)
+
+        if self.mapping is not None:
+            return self.mapping[offset:offset + length]
+
+        parts = []
+        done = 0
+
+        while done < length:
+            part = self.read_at(offset + done, length - done)
+            if not part:
+                break
+
+            parts.append(part)
+            done += len(part)
+
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+
+    def close(self):
+        if self.mapping is not None:
+            self.mapping.close()
+
+        os.close(self.fd)
+
 
 class FileSystem(drivers.driver.Driver):
-    def delete_directory(self, directoryName):
-        os.rmdir("data12" + directoryName)
+    concurrency = 16
+    supports_read_range = True
+
+    # root is the directory everything is stored under. Up to open_files of the files read
+    # most recently are kept open, and with use_mmap they are read through a memory map.
+    def __init__(self, root=DEFAULT_ROOT, open_files=64, use_mmap=False):
+        self.root = os.path.abspath(root)
+        self.max_open_files = max(open_files, 1)
+        self.use_mmap = use_mmap
+
+        # Path -> OpenFile. Each is stamped from use_counter when it is used, and the least
+        # recently used ones are closed when there are too many.
+        self.open_files = {}
+        self.use_counter = itertools.count()
+        self.open_files_lock = threading.Lock()
+
+    def get_path(self, name):
+        return self.root + name
+
+    #
+    # Return the open file for path, which must be given back to release() once read from.
+    def acquire(self, path):
+        with self.open_files_lock:
+            open_file = self.open_files.get(path)
+            if open_file is None:
+                if len(self.open_files) >= self.max_open_files:
+                    self.retire(self.open_files.pop(min(self.open_files, key=lambda name: self.open_files[name].used)))
+
+                open_file = self.open_files[path] = OpenFile(path, self.use_mmap)
+
+            open_file.used = next(self.use_counter)
+            open_file.users += 1
+
+        return open_file
+
+    def release(self, open_file):
+        with self.open_files_lock:
+            open_file.users -= 1
+
+            if open_file.retired and not open_file.users:
+                open_file.close()
+
+    # Called with open_files_lock held.
+    def retire(self, open_file):
+        open_file.retired = True
+
+        if not open_file.users:
+            open_file.close()
+
+    #
+    # Stop reading a file through the descriptor kept for it, after it was replaced or deleted.
+    def forget(self, path):
+        with self.open_files_lock:
+            open_file = self.open_files.pop(path, None)
+
+            if open_file is not None:
+                self.retire(open_file)
+
+    def init(self):
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
         return True
 
+    def delete_directory(self, directoryName):
+        try:
+            os.rmdir(self.get_path(directoryName))
+            return True
+        except OSError:
+            return False
+
+    def delete_file(self, fileName):
+        path = self.get_path(fileName)
+        self.forget(path)
+
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    #
+    # The contents are written to a temporary file which then replaces the file, so a
+    # reader sees either the old contents or the new ones and a crash leaves no torn file.
     def write_file(self, fileName, fileContents):
-        file = open("data12" + fileName, 'w+')
-        file.write(fileContents)
+        path = self.get_path(fileName)
+        temporary_path = '{}.{}{}'.format(path, uuid.uuid4().hex, TEMPORARY_SUFFIX)
+
+        try:
+            fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+        except OSError:
+            return False
+
+        try:
+            try:
+                contents = memoryview(fileContents)
+                written = 0
+
+                while written < len(contents):
+                    written += os.write(fd, contents[written:])
+            finally:
+                os.close(fd)
+
+            os.rename(temporary_path, path)
+        except OSError:
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
+
+            return False
+
+        self.forget(path)
         return True
 
+    # Called through the class, as a subclass such as drivers.simulated.SimulatedDriver
+    # wraps readFile and read_range alike and would count the read twice.
     def readFile(self, fileName):
+        return FileSystem.read_range(self, fileName, 0, None)
+
+    def read_range(self, fileName, offset, length):
         try:
-            file = open("data12" + fileName, 'r')
-            return file.read()
-        except:
+            open_file = self.acquire(self.get_path(fileName))
+        except (IOError, OSError):
             return False
 
+        try:
+            return open_file.read(offset, open_file.size if length is None else length)
+        except (IOError, OSError):
+            return False
+        finally:
+            self.release(open_file)
+
     def make_directory(self, directoryName):
-        print("Making directories")
-        if not os.path.exists("data12" + directoryName):
-            os.makedirs("data12" + directoryName)
+        path = self.get_path(directoryName)
+
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Another thread may have just made it.
+            if not os.path.isdir(path):
+                return False
+
         return True
 
     def list_files(self, directoryName):
-        return os.listdir("data12" + directoryName)
+        try:
+            return [name for name in os.listdir(self.get_path(directoryName))
+                    if not name.endswith(TEMPORARY_SUFFIX)]
+        except OSError:
+            return False
 
     def getSize(self, fileName):
-        return os.path.getsize("data12" + fileName)
+        return os.path.getsize(self.get_path(fileName))
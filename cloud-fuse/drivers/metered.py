@@ -0,0 +1,58 @@
+#
+# @file  metered.py
+#
+# @brief Wraps a driver and records the count, latency, bytes and failures of every call made to it.
+#
+
+import time
+
+
+class MeteredDriver:
+    def __init__(self, driver, metrics, name=None):
+        self.driver = driver
+        self.metrics = metrics
+        self.name = name or driver.__class__.__name__
+
+    # Anything that is not a metered call, such as concurrency, comes from the wrapped driver.
+    def __getattr__(self, attribute):
+        return getattr(self.driver, attribute)
+
+    #
+    # Run a driver call and record it. sent is the number of bytes uploaded by the
+    # call, for downloads the size of the result is counted. Drivers report
+    # failure by returning False.
+    def call(self, call, arguments, sent=None):
+        start = time.time()
+        result = False
+
+        try:
+            result = getattr(self.driver, call)(*arguments)
+            return result
+        finally:
+            size = sent if sent is not None else (len(result) if isinstance(result, bytes) else 0)
+            self.metrics.record_call(self.name, call, time.time() - start, size if result is not False else 0,
+                                     failed=result is False)
+
+    def write_file(self, fileName, fileContents):
+        return self.call('write_file', (fileName, fileContents), sent=len(fileContents))
+
+    def readFile(self, fileName):
+        return self.call('readFile', (fileName,))
+
+    def read_range(self, fileName, offset, length):
+        return self.call('read_range', (fileName, offset, length))
+
+    def delete_file(self, fileName):
+        return self.call('delete_file', (fileName,), sent=0)
+
+    def make_directory(self, directoryName):
+        return self.call('make_directory', (directoryName,), sent=0)
+
+    def delete_directory(self, directoryName):
+        return self.call('delete_directory', (directoryName,), sent=0)
+
+    def list_files(self, directoryName):
+        return self.call('list_files', (directoryName,), sent=0)
+
+    def init(self):
+        return self.driver.init()
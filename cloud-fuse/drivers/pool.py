@@ -0,0 +1,50 @@
+import contextlib
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+#
+# A bounded pool of client connections, so that several threads can talk to a
+# provider at once without sharing a client that is not thread safe.
+class ConnectionPool:
+    def __init__(self, create_connection, size=8):
+        self.create_connection = create_connection
+        self.size = size
+        self.created = 0
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+        client = self.acquire()
+
+        try:
+            yield client
+        finally:
+            self.idle.put(client)
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+
+        if not create:
+            # Every connection is in use, wait for one to be returned.
+            return self.idle.get()
+
+        try:
+            return self.create_connection()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
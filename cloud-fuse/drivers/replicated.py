@@ -0,0 +1,242 @@
+#
+# @file  replicated.py
+#
+# @brief Writes every stored object to several drivers and reads it back from whichever
+#        replica has been fastest lately. A read that takes longer than usual is hedged:
+#        the next replica is asked as well, and the first answer wins.
+#
+
+import collections
+import threading
+import time
+import zlib
+
+import drivers.driver
+import drivers.scheduled
+import helpers.transfer
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+# Latencies kept per replica to estimate its recent percentiles from.
+LATENCY_WINDOW = 256
+# Reads are not hedged until a replica has this many recent latencies to set a deadline from.
+MINIMUM_SAMPLES = 16
+
+
+class ReplicaStats:
+    def __init__(self):
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        # Exponentially weighted moving average of the latency, in seconds.
+        self.average = None
+        self.calls = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def record(self, seconds, failed):
+        with self.lock:
+            self.calls += 1
+
+            if failed:
+                self.failures += 1
+                return
+
+            self.latencies.append(seconds)
+            self.average = seconds if self.average is None else 0.8 * self.average + 0.2 * seconds
+
+    def percentile(self, fraction):
+        with self.lock:
+            latencies = sorted(self.latencies)
+
+        if len(latencies) < MINIMUM_SAMPLES:
+            return None
+
+        return latencies[min(int(fraction * len(latencies)), len(latencies) - 1)]
+
+    #
+    # A replica that keeps failing is tried after the ones that work.
+    def expected_latency(self):
+        with self.lock:
+            if self.failures and self.failures * 2 >= self.calls:
+                return float('inf')
+
+            return self.average or 0.0
+
+    def snapshot(self):
+        return dict(
+            calls=self.calls,
+            failures=self.failures,
+            average=self.average,
+            p50=self.percentile(0.5),
+            p90=self.percentile(0.9),
+            p99=self.percentile(0.99)
+        )
+
+
+class ReplicatedDriver(drivers.driver.Driver):
+    # backends are the drivers to replicate over, each object is written to copies of them.
+    # A read is hedged once it has taken longer than hedge_percentile of the recent reads
+    # from the replica it was sent to.
+    def __init__(self, backends, copies=2, hedge_percentile=0.95):
+        self.backends = backends
+        self.copies = max(1, min(copies, len(backends)))
+        self.hedge_percentile = hedge_percentile
+
+        # Metered backends are already named, anything else is named after its class and place.
+        self.names = [getattr(backend, 'name', None) or '{}.{}'.format(backend.__class__.__name__, number)
+                      for number, backend in enumerate(backends)]
+        self.replica_stats = [ReplicaStats() for backend in backends]
+
+        # Hedged reads are raced on a pool of their own, as the caller is usually a transfer thread.
+        self.pool = helpers.transfer.TransferPool(self.concurrency * 2)
+
+        # Reads hedged after a deadline, and reads answered by a replica other than the first asked.
+        self.hedges = 0
+        self.backup_answers = 0
+        self.lock = threading.Lock()
+
+    #
+    # Both are read from the backends every time, as a deferred backend only knows them once it has loaded.
+    @property
+    def concurrency(self):
+        return sum(backend.concurrency for backend in self.backends)
+
+    @property
+    def supports_read_range(self):
+        return all(backend.supports_read_range for backend in self.backends)
+
+    #
+    # The backends holding an object, the same ones every time for the same name.
+    def get_replicas(self, fileName):
+        first = (zlib.crc32(fileName.encode('utf-8')) & 0xffffffff) % len(self.backends)
+
+        return [(first + number) % len(self.backends) for number in range(self.copies)]
+
+    #
+    # Calls run on the pool of this driver, at the priority of the thread that made them.
+    def call_backend(self, replica, call, arguments, level=None):
+        start = time.time()
+        result = False
+
+        try:
+            with drivers.scheduled.priority(level):
+                result = getattr(self.backends[replica], call)(*arguments)
+        finally:
+            self.replica_stats[replica].record(time.time() - start, result is False)
+
+        return result
+
+    def call_replicas(self, call, fileName, *arguments):
+        level = drivers.scheduled.get_priority()
+        results = self.pool.map(lambda replica: self.call_backend(replica, call, (fileName,) + arguments, level),
+                                self.get_replicas(fileName))
+
+        return all(result is not False for result in results)
+
+    #
+    # Read from the replica expected to answer first. Whenever the latest request has
+    # gone past its deadline, or a request fails, the next replica is asked too.
+    def hedged_read(self, call, fileName, *arguments):
+        replicas = sorted(self.get_replicas(fileName),
+                          key=lambda replica: self.replica_stats[replica].expected_latency())
+        # (replica, result) pairs, or (None, number of replicas asked) when a deadline passes.
+        answers = queue.Queue()
+        asked = 0
+        waiting = 0
+        level = drivers.scheduled.get_priority()
+
+        def ask(replica):
+            try:
+                answers.put((replica, self.call_backend(replica, call, (fileName,) + arguments, level)))
+            except Exception:
+                answers.put((replica, False))
+
+        while True:
+            if waiting == 0 and asked < len(replicas):
+                self.pool.submit(ask, replicas[asked])
+                asked += 1
+                waiting += 1
+
+            # Waiting with a timeout polls on Python 2, so the deadline is kept by a timer
+            # and the answer is waited for without one.
+            timer = None
+            if asked < len(replicas):
+                deadline = self.replica_stats[replicas[asked - 1]].percentile(self.hedge_percentile)
+
+                if deadline is not None:
+                    timer = threading.Timer(deadline, answers.put, [(None, asked)])
+                    timer.daemon = True
+                    timer.start()
+
+            replica, result = answers.get()
+
+            if timer:
+                timer.cancel()
+
+            if replica is None:
+                # A timer that fired just before it was cancelled is out of date.
+                if result == asked and asked < len(replicas):
+                    with self.lock:
+                        self.hedges += 1
+
+                    self.pool.submit(ask, replicas[asked])
+                    asked += 1
+                    waiting += 1
+
+                continue
+
+            waiting -= 1
+
+            if result is not False:
+                if replica != replicas[0]:
+                    with self.lock:
+                        self.backup_answers += 1
+
+                return result
+
+            if waiting == 0 and asked == len(replicas):
+                return False
+
+    def write_file(self, fileName, fileContents):
+        return self.call_replicas('write_file', fileName, fileContents)
+
+    def readFile(self, fileName):
+        return self.hedged_read('readFile', fileName)
+
+    def read_range(self, fileName, offset, length):
+        return self.hedged_read('read_range', fileName, offset, length)
+
+    def delete_file(self, fileName):
+        return self.call_replicas('delete_file', fileName)
+
+    def make_directory(self, directoryName):
+        return all([backend.make_directory(directoryName) is not False for backend in self.backends])
+
+    def delete_directory(self, directoryName):
+        return all([backend.delete_directory(directoryName) is not False for backend in self.backends])
+
+    def list_files(self, directoryName):
+        listings = [backend.list_files(directoryName) for backend in self.backends]
+
+        if any(listing is False for listing in listings):
+            return False
+
+        return sorted(set(name for listing in listings for name in listing))
+
+    def init(self):
+        for backend in self.backends:
+            backend.init()
+
+        return True
+
+    #
+    # Recent latency of every replica, and how often reads were hedged.
+    def stats(self):
+        return dict(
+            replicas=dict((name, stats.snapshot()) for name, stats in zip(self.names, self.replica_stats)),
+            hedges=self.hedges,
+            backup_answers=self.backup_answers
+        )
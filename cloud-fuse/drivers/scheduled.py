@@ -0,0 +1,328 @@
+#
+# @file  scheduled.py
+#
+# @brief Paces the calls made to a driver. A token bucket keeps calls under the provider's rate
+#        limit and slows down whenever the provider says so, failed calls are retried with
+#        exponential backoff and jitter, a circuit breaker stops calling a provider that keeps
+#        failing, and waiting calls run in order of priority so that reads someone is waiting
+#        for go ahead of prefetching and uploads.
+#
+
+import contextlib
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+import drivers.driver
+
+log = logging.getLogger('cloud-fuse')
+
+# Priorities, lower runs first.
+FOREGROUND = 0
+PREFETCH = 1
+BACKGROUND = 2
+
+# Calls that are foreground unless the caller says otherwise, everything else is background.
+READ_CALLS = ('readFile', 'read_range', 'list_files')
+# Calls for which returning False is a failure worth retrying. A read or delete returning
+# False usually means the file is not there, and making a directory that it is already
+# there, neither of which retrying will change.
+RETRY_FALSE_CALLS = ('write_file',)
+
+local = threading.local()
+
+
+#
+# Run the driver calls made by this thread inside the block at the given priority.
+@contextlib.contextmanager
+def priority(level):
+    previous = get_priority()
+    local.priority = level
+
+    try:
+        yield
+    finally:
+        local.priority = previous
+
+
+def get_priority():
+    return getattr(local, 'priority', None)
+
+
+class TokenBucket:
+    # rate is in calls per second, None to only limit once the provider has asked to slow
+    # down. Up to burst calls can be made at once after a quiet spell.
+    def __init__(self, rate=None, burst=None, minimum_rate=0.5):
+        self.rate = rate
+        self.maximum_rate = rate
+        self.minimum_rate = minimum_rate
+        # Without a configured burst, up to a second's worth of calls can be made at once.
+        self.configured_burst = burst
+        self.burst = burst or max(rate or 1, 1)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.slowed = 0
+        # When unlimited, the times of the calls that worked in the last second, to start limiting from.
+        self.recent_calls = []
+        self.lock = threading.Lock()
+
+    #
+    # Take a token, returning how many seconds to wait before using it.
+    def take(self):
+        with self.lock:
+            now = time.time()
+
+            if self.rate is None:
+                return 0
+
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    #
+    # Halve the rate after the provider turned a call away. The calls that were already on
+    # their way are turned away too, so the rate is halved at most once a second. Without a
+    # rate or any recent call that worked to halve, waiting as long as the provider asked
+    # is all there is to do.
+    def slow_down(self):
+        with self.lock:
+            now = time.time()
+
+            if self.rate is not None:
+                # The call turned away gets its token back, but there is no burst to be had.
+                self.tokens = min(self.tokens + 1, 0)
+
+            if now - self.slowed < 1 or (self.rate is None and not self.recent_calls):
+                return
+
+            self.slowed = now
+            current_rate = self.rate if self.rate is not None else len(self.recent_calls)
+
+            self.rate = max(current_rate / 2.0, self.minimum_rate)
+            self.burst = self.configured_burst or max(self.rate, 1)
+            self.updated = now
+
+    #
+    # Creep back up after every successful call, to the configured rate if there is one.
+    def speed_up(self):
+        with self.lock:
+            if self.rate is None:
+                now = time.time()
+                self.recent_calls = [called for called in self.recent_calls if called > now - 1] + [now]
+                return
+
+            # A little more for every call that worked, so the rate grows by a quarter a second.
+            self.rate += 0.25
+            if self.maximum_rate is not None:
+                self.rate = min(self.rate, self.maximum_rate)
+
+            self.burst = self.configured_burst or max(self.rate, 1)
+
+    def stats(self):
+        return dict(rate=self.rate, configured_rate=self.maximum_rate)
+
+
+#
+# Opens after threshold failed calls in a row, failing every call at once for reset_timeout
+# seconds. After that one call is let through to try the provider again: the circuit closes
+# if it works and opens again if it does not.
+class CircuitBreaker:
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.trying = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+
+            if self.trying or time.time() - self.opened < self.reset_timeout:
+                return False
+
+            self.trying = True
+            return True
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trying = False
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+
+            if self.trying or self.failures >= self.threshold:
+                if self.opened is None or self.trying:
+                    log.warning("Too many failed calls to the driver, pausing calls for %d seconds",
+                                self.reset_timeout)
+
+                self.opened = time.time()
+                self.trying = False
+
+    def state(self):
+        with self.lock:
+            if self.opened is None:
+                return 'closed'
+
+            return 'half-open' if self.trying else 'open'
+
+
+class ScheduledDriver:
+    # Runs at most driver.concurrency calls at once. retries is how many times a failed call
+    # is made again, waiting base_delay doubling up to max_delay seconds, times a random jitter.
+    def __init__(self, driver, rate=None, retries=4, base_delay=0.2, max_delay=30.0, failure_threshold=5,
+                 reset_timeout=30.0, metrics=None, name=None):
+        self.driver = driver
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = metrics
+        self.name = name or getattr(driver, 'name', None) or driver.__class__.__name__
+
+        self.bucket = TokenBucket(rate)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.random = random.Random()
+
+        self.slots = driver.concurrency
+        self.running = 0
+        # Heap of (priority, arrival) for the calls waiting for a slot.
+        self.waiting = []
+        self.arrivals = itertools.count()
+        self.condition = threading.Condition()
+
+        # Calls wait until then after the provider asked for a pause.
+        self.paused_until = 0
+        self.throttled = 0
+        self.retried = 0
+
+    # Anything that is not a scheduled call, such as concurrency, comes from the wrapped driver.
+    def __getattr__(self, attribute):
+        return getattr(self.driver, attribute)
+
+    #
+    # Wait for a free slot, behind every waiting call of a higher priority.
+    def acquire(self, level):
+        with self.condition:
+            entry = (level, next(self.arrivals))
+            heapq.heappush(self.waiting, entry)
+
+            while self.running >= self.slots or self.waiting[0] != entry:
+                self.condition.wait()
+
+            heapq.heappop(self.waiting)
+            self.running += 1
+            # The next call in line may fit in another free slot.
+            self.condition.notify_all()
+
+    def release(self):
+        with self.condition:
+            self.running -= 1
+            self.condition.notify_all()
+
+    def pause(self, seconds):
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+    #
+    # Full jitter: anything from nothing up to the exponential delay, so that calls
+    # that failed together do not all come back together.
+    def get_backoff(self, attempt):
+        return self.random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, call, arguments):
+        level = get_priority()
+        if level is None:
+            level = FOREGROUND if call in READ_CALLS else BACKGROUND
+
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                return False
+
+            retry_after = None
+            error = None
+
+            self.acquire(level)
+            try:
+                delay = max(self.paused_until - time.time(), 0) + self.bucket.take()
+                if delay > 0:
+                    time.sleep(delay)
+
+                try:
+                    result = getattr(self.driver, call)(*arguments)
+                except drivers.driver.RateLimited as rate_limited:
+                    result = False
+                    error = rate_limited
+                    retry_after = rate_limited.retry_after or self.get_backoff(attempt)
+                except Exception as exception:
+                    result = False
+                    error = exception
+            finally:
+                self.release()
+
+            if isinstance(error, drivers.driver.RateLimited):
+                # Being turned away says nothing about whether the provider works.
+                self.throttled += 1
+                self.bucket.slow_down()
+                self.pause(retry_after)
+                log.debug("%s turned away %s, waiting %.2f seconds", self.name, call, retry_after)
+            elif error is None and (result is not False or call not in RETRY_FALSE_CALLS):
+                self.breaker.succeeded()
+                self.bucket.speed_up()
+                return result
+            else:
+                self.breaker.failed()
+                log.debug("%s %s failed: %s", self.name, call, error)
+
+            if attempt == self.retries:
+                break
+
+            self.retried += 1
+            if self.metrics:
+                self.metrics.record_retry(self.name, call)
+
+            if retry_after is None:
+                time.sleep(self.get_backoff(attempt))
+
+        return False
+
+    def write_file(self, fileName, fileContents):
+        return self.call('write_file', (fileName, fileContents))
+
+    def readFile(self, fileName):
+        return self.call('readFile', (fileName,))
+
+    def read_range(self, fileName, offset, length):
+        return self.call('read_range', (fileName, offset, length))
+
+    def delete_file(self, fileName):
+        return self.call('delete_file', (fileName,))
+
+    def make_directory(self, directoryName):
+        return self.call('make_directory', (directoryName,))
+
+    def delete_directory(self, directoryName):
+        return self.call('delete_directory', (directoryName,))
+
+    def list_files(self, directoryName):
+        return self.call('list_files', (directoryName,))
+
+    def init(self):
+        return self.driver.init()
+
+    def stats(self):
+        with self.condition:
+            waiting = len(self.waiting)
+            running = self.running
+
+        return dict(self.bucket.stats(), circuit=self.breaker.state(), running=running, waiting=waiting,
+                    throttled=self.throttled, retried=self.retried)
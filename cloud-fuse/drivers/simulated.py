@@ -0,0 +1,149 @@
+#
+# @file  simulated.py
+#
+# @brief Local filesystem driver that behaves like a remote provider: every call pays a round trip,
+#        transfers share a bandwidth limited link, and calls can be made to fail at random.
+#
+
+import collections
+import random
+import threading
+import time
+
+import drivers.driver
+import drivers.filesystem
+
+
+class SimulatedDriver(drivers.filesystem.FileSystem):
+    # rtt and jitter are in seconds, bandwidth in bytes per second (None for unlimited)
+    # and error_rate is the chance of any single call failing with drivers.driver.TransientError,
+    # like a server error or a dropped connection. A slow_rate share of calls
+    # take slow_delay seconds longer, for the long tail of real providers. Calls beyond
+    # rate_limit a second are turned away with drivers.driver.RateLimited, like a 429.
+    def __init__(self, rtt=0.05, bandwidth=None, jitter=0.0, error_rate=0.0, concurrency=8, seed=None,
+                 slow_rate=0.0, slow_delay=0.0, rate_limit=None):
+        drivers.filesystem.FileSystem.__init__(self)
+
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+        self.rate_limit = rate_limit
+        # Calls that can be made right now under the rate limit.
+        self.allowance = rate_limit or 0
+        self.allowance_updated = time.time()
+        self.concurrency = concurrency
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # When the simulated link finishes the transfers queued on it so far.
+        self.link_free = 0.0
+
+        self.calls = collections.Counter()
+        self.errors = collections.Counter()
+        self.throttled = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    #
+    # Account for a call moving size bytes and sleep for as long as it would take.
+    # Raises TransientError if the call should fail, and RateLimited when it is over the rate limit.
+    def simulate(self, operation, size=0, written=False):
+        with self.lock:
+            self.calls[operation] += 1
+            now = time.time()
+            retry_after = None
+
+            if self.rate_limit:
+                self.allowance = min(self.rate_limit,
+                                     self.allowance + (now - self.allowance_updated) * self.rate_limit)
+                self.allowance_updated = now
+
+                if self.allowance < 1:
+                    self.throttled += 1
+                    retry_after = (1 - self.allowance) / self.rate_limit
+                else:
+                    self.allowance -= 1
+
+            if retry_after is not None:
+                failed = True
+            elif self.random.random() < self.error_rate:
+                self.errors[operation] += 1
+                failed = True
+            else:
+                failed = False
+
+            finish = now + self.rtt + self.random.uniform(0, self.jitter)
+            if self.random.random() < self.slow_rate:
+                finish += self.slow_delay
+
+            if self.bandwidth and size and not failed:
+                # Transfers queue up behind each other on the shared link.
+                finish = max(finish, self.link_free) + size / float(self.bandwidth)
+                self.link_free = finish
+
+            if not failed:
+                if written:
+                    self.bytes_written += size
+                else:
+                    self.bytes_read += size
+
+        time.sleep(max(finish - now, 0))
+
+        if retry_after is not None:
+            raise drivers.driver.RateLimited(retry_after)
+
+        if failed:
+            raise drivers.driver.TransientError('simulated {} failure'.format(operation))
+
+    def write_file(self, fileName, fileContents):
+        self.simulate('write_file', len(fileContents), written=True)
+        return drivers.filesystem.FileSystem.write_file(self, fileName, fileContents)
+
+    def readFile(self, fileName):
+        contents = drivers.filesystem.FileSystem.readFile(self, fileName)
+
+        self.simulate('readFile', len(contents or b""))
+        return contents
+
+    def read_range(self, fileName, offset, length):
+        contents = drivers.filesystem.FileSystem.read_range(self, fileName, offset, length)
+
+        self.simulate('read_range', len(contents or b""))
+        return contents
+
+    def delete_file(self, fileName):
+        self.simulate('delete_file')
+        return drivers.filesystem.FileSystem.delete_file(self, fileName)
+
+    def make_directory(self, directoryName):
+        self.simulate('make_directory')
+        return drivers.filesystem.FileSystem.make_directory(self, directoryName)
+
+    def delete_directory(self, directoryName):
+        self.simulate('delete_directory')
+        return drivers.filesystem.FileSystem.delete_directory(self, directoryName)
+
+    def list_files(self, directoryName):
+        self.simulate('list_files')
+        return drivers.filesystem.FileSystem.list_files(self, directoryName)
+
+    def init(self):
+        try:
+            self.simulate('init')
+        except drivers.driver.TransientError:
+            return False
+
+        return True
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                calls=dict(self.calls),
+                errors=dict(self.errors),
+                throttled=self.throttled,
+                bytes_read=self.bytes_read,
+                bytes_written=self.bytes_written
+            )
@@ -0,0 +1,147 @@
+#
+# @file  striped.py
+#
+# @brief Spreads stored objects over several drivers, so that their bandwidth and request
+#        limits add up. Each object lives on one stripe, chosen round-robin or by name.
+#
+
+import itertools
+import threading
+import zlib
+
+import drivers.driver
+
+ROUND_ROBIN = 'round-robin'
+HASH = 'hash'
+
+
+class StripedDriver(drivers.driver.Driver):
+    # backends are the drivers to stripe over. Placement is one of ROUND_ROBIN or HASH.
+    # locate(fileName) returns the stripe an object was written to, from the metadata,
+    # for objects this driver has not seen since it was created.
+    def __init__(self, backends, placement=ROUND_ROBIN, locate=None):
+        self.backends = backends
+        self.placement = placement
+        self.locate = locate
+
+        self.counter = itertools.count()
+        # File name -> stripe, for every object written or located so far.
+        self.stripes = {}
+        self.lock = threading.Lock()
+
+    #
+    # Transfers to different stripes do not compete, so the concurrencies add up. Both are read
+    # from the backends every time, as a deferred backend only knows them once it has loaded.
+    @property
+    def concurrency(self):
+        return sum(backend.concurrency for backend in self.backends)
+
+    @property
+    def supports_read_range(self):
+        return all(backend.supports_read_range for backend in self.backends)
+
+    def choose_stripe(self, fileName):
+        if self.placement == HASH:
+            return (zlib.crc32(fileName.encode('utf-8')) & 0xffffffff) % len(self.backends)
+
+        return next(self.counter) % len(self.backends)
+
+    #
+    # Return the stripe holding an object, or None if it is not known.
+    def get_stripe(self, fileName):
+        with self.lock:
+            stripe = self.stripes.get(fileName)
+
+        if stripe is None and self.locate:
+            stripe = self.locate(fileName)
+
+        if stripe is None and self.placement == HASH:
+            stripe = self.choose_stripe(fileName)
+
+        if stripe is not None and 0 <= stripe < len(self.backends):
+            with self.lock:
+                self.stripes[fileName] = stripe
+
+            return stripe
+
+        return None
+
+    #
+    # Choose the stripe of an object before it is written, for an object that waits in
+    # helpers.journal.UploadJournal, so that the stripe can be recorded with it now.
+    def place(self, fileName):
+        stripe = self.get_stripe(fileName)
+
+        if stripe is None:
+            stripe = self.choose_stripe(fileName)
+
+            with self.lock:
+                self.stripes[fileName] = stripe
+
+        return stripe
+
+    #
+    # Call every stripe that may hold an object: the one it is known to be on, or all of them.
+    def call_placed(self, call, fileName, *arguments):
+        stripe = self.get_stripe(fileName)
+
+        if stripe is not None:
+            return getattr(self.backends[stripe], call)(fileName, *arguments)
+
+        for backend in self.backends:
+            result = getattr(backend, call)(fileName, *arguments)
+            if result is not False:
+                return result
+
+        return False
+
+    #
+    # An object that is already stored, which happens when a write is retried, stays on its
+    # stripe, as does one that was placed and recorded before a remount.
+    def write_file(self, fileName, fileContents):
+        stripe = self.get_stripe(fileName)
+
+        if stripe is None:
+            stripe = self.choose_stripe(fileName)
+
+        if not self.backends[stripe].write_file(fileName, fileContents):
+            return False
+
+        with self.lock:
+            self.stripes[fileName] = stripe
+
+        return True
+
+    def readFile(self, fileName):
+        return self.call_placed('readFile', fileName)
+
+    def read_range(self, fileName, offset, length):
+        return self.call_placed('read_range', fileName, offset, length)
+
+    def delete_file(self, fileName):
+        result = self.call_placed('delete_file', fileName)
+
+        with self.lock:
+            self.stripes.pop(fileName, None)
+
+        return result
+
+    def make_directory(self, directoryName):
+        return all([backend.make_directory(directoryName) is not False for backend in self.backends])
+
+    def delete_directory(self, directoryName):
+        return all([backend.delete_directory(directoryName) is not False for backend in self.backends])
+
+    def list_files(self, directoryName):
+        listings = [backend.list_files(directoryName) for backend in self.backends]
+
+        if any(listing is False for listing in listings):
+            return False
+
+        return sorted(set(itertools.chain.from_iterable(listings)))
+
+    def init(self):
+        for backend in self.backends:
+            backend.init()
+
+        return True
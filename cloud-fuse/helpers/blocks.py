@@ -1,41 +1,48 @@
-import md5
-import os
+import hashlib
 
 
 #
 # Take a string, and split into chunks the size of chunkSize.
-# The final string will be string%chunkSize .
+# The final string will be string%chunkSize . The chunks are memoryviews
+# of string, so splitting copies nothing however long the string is.
 def string_to_chunks(string, chunkSize, first_block_size=False):
-    if not first_block_size:
-        first_block_size = chunkSize
+    view = memoryview(string)
+    position = 0
+    size = first_block_size or chunkSize
 
-    first_block = True
-    while string:
-        if first_block :
-            yield string[:first_block_size]
-            string = string[first_block_size:]
-            continue
+    while position < len(view):
+        yield view[position:position + size]
+        position += size
+        size = chunkSize
 
-        yield string[:chunkSize]
-        string = string[chunkSize:]
-
-def get_block_root(path):
-    md5_instance = md5.new()
-    md5_instance.update(path)
+#
+# Return length bytes of contents from offset without copying them: contents itself
+# when that is all of it, otherwise a memoryview.
+def view_range(contents, offset, length):
+    if offset == 0 and length >= len(contents):
+        return contents
 
-    return '/files/{}/blocks/'.format(md5_instance.hexdigest())
+    return memoryview(contents)[offset:offset + length]
 
-def list_blocks(path, driver):
-    block_root = get_block_root(path)
+#
+# Return contents, which may be a memoryview or a bytearray, as bytes. Bytes are returned as they are.
+def to_bytes(contents):
+    if isinstance(contents, bytes):
+        return contents
 
-    blocks = os.listdir(block_root)
-    return len(blocks)
+    return memoryview(contents).tobytes()
 
-def get_size_of_file(path, driver):
-    total_size = 0
-    block_root = get_block_root(path)
+#
+# Blocks are stored under the md5 of their contents, spread over 256 directories
+# so that no single remote directory grows too large.
+def get_block_directory(block_hash):
+    return '/blocks/{}/'.format(block_hash[:2])
 
-    for block in driver.list_files(block_root):
-        total_size += driver.getSize(block_root+block)
+def get_block_name(block_hash):
+    return get_block_directory(block_hash) + block_hash
 
-    return total_size
\ No newline at end of file
+#
+# Before blocks were stored by content, the blocks of a file were numbered from 1 in a
+# directory named after the md5 of its path. Only used to migrate such filesystems.
+def get_path_block_directory(path):
+    return '/files/{}/blocks/'.format(hashlib.md5(path.encode('utf-8')).hexdigest())
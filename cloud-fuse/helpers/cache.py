@@ -0,0 +1,181 @@
+#
+# @file  cache.py
+#
+# @brief Local on-disk cache of remote blocks, placed in front of a driver.
+#
+
+import collections
+import hashlib
+import os
+import threading
+
+
+class BlockCache:
+    def __init__(self, cache_directory, max_bytes):
+        self.cache_directory = cache_directory
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Remote block name -> size on disk, least recently used first.
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        if not os.path.exists(cache_directory):
+            os.makedirs(cache_directory)
+
+        # Indexing a big cache takes a while, so it is done in the background and
+        # lookups wait for it rather than holding up the mount.
+        self.loaded = threading.Event()
+        loader = threading.Thread(target=self.load)
+        loader.daemon = True
+        loader.start()
+
+    #
+    # Rebuild the LRU order from what is already on disk so that the cache
+    # survives a remount. Access time is kept in the file mtime.
+    def load(self):
+        index = []
+
+        try:
+            for cache_file in os.listdir(self.cache_directory):
+                if cache_file.endswith('.tmp'):
+                    os.remove(os.path.join(self.cache_directory, cache_file))
+                    continue
+
+                file_stat = os.stat(os.path.join(self.cache_directory, cache_file))
+                index.append((file_stat.st_mtime, cache_file, file_stat.st_size))
+
+            with self.lock:
+                for mtime, cache_file, size in sorted(index):
+                    self.entries[cache_file] = size
+                    self.used_bytes += size
+
+                evicted = self.evict()
+
+            self.remove(evicted)
+        finally:
+            self.loaded.set()
+
+    def get_cache_path(self, name):
+        md5_instance = hashlib.md5()
+        md5_instance.update(name.encode('utf-8'))
+
+        return os.path.join(self.cache_directory, md5_instance.hexdigest())
+
+    #
+    # Return the cached contents of the block, or None on a miss.
+    # If expected_hash is given the cached copy is only returned when its md5
+    # matches, otherwise it is dropped and treated as a miss. The lock is only
+    # held to look the block up and move it in the LRU order, never for file I/O.
+    def get(self, name, expected_hash=None):
+        cache_path = self.get_cache_path(name)
+        key = os.path.basename(cache_path)
+        self.loaded.wait()
+
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+        # An eviction may remove the file before it is opened, which is a miss like any other.
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                contents = cache_file.read()
+        except (IOError, OSError):
+            contents = None
+
+        if contents is None or (expected_hash and hashlib.md5(contents).hexdigest() != expected_hash):
+            with self.lock:
+                dropped = self.drop(key)
+                self.misses += 1
+
+            self.remove(dropped)
+            return None
+
+        with self.lock:
+            if key in self.entries:
+                self.entries[key] = self.entries.pop(key)
+            self.hits += 1
+
+        try:
+            os.utime(cache_path, None)
+        except OSError:
+            pass
+
+        return contents
+
+    def put(self, name, contents):
+        if len(contents) > self.max_bytes:
+            return
+
+        cache_path = self.get_cache_path(name)
+        key = os.path.basename(cache_path)
+        self.loaded.wait()
+
+        # Write then rename so that a crash never leaves a torn block behind. Each
+        # thread writes its own temporary file, as the same block may be put twice at once.
+        temporary_path = '{}.{}.tmp'.format(cache_path, threading.current_thread().ident)
+        with open(temporary_path, 'wb') as cache_file:
+            cache_file.write(contents)
+        os.rename(temporary_path, cache_path)
+
+        with self.lock:
+            if key in self.entries:
+                self.used_bytes -= self.entries.pop(key)
+
+            self.entries[key] = len(contents)
+            self.used_bytes += len(contents)
+
+            evicted = self.evict()
+
+        self.remove(evicted)
+
+    def invalidate(self, name):
+        self.loaded.wait()
+
+        with self.lock:
+            dropped = self.drop(os.path.basename(self.get_cache_path(name)))
+
+        self.remove(dropped)
+
+    #
+    # Forget a block, returning the keys whose files should be removed once the lock is released.
+    def drop(self, key):
+        if key not in self.entries:
+            return []
+
+        self.used_bytes -= self.entries.pop(key)
+
+        return [key]
+
+    #
+    # Forget the least recently used blocks until the cache fits, returning their keys as drop does.
+    def evict(self):
+        evicted = []
+
+        while self.used_bytes > self.max_bytes and self.entries:
+            evicted.extend(self.drop(next(iter(self.entries))))
+            self.evictions += 1
+
+        return evicted
+
+    def remove(self, keys):
+        for key in keys:
+            try:
+                os.remove(os.path.join(self.cache_directory, key))
+            except OSError:
+                pass
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            used_bytes=self.used_bytes,
+            max_bytes=self.max_bytes,
+            entries=len(self.entries)
+        )
@@ -0,0 +1,96 @@
+#
+# @file  chunking.py
+#
+# @brief Content-defined chunking (FastCDC style gear hash), an alternative to splitting files at fixed
+#        BlockSize boundaries. Cut points depend only on the bytes near them, so an edit only changes
+#        the chunks around it and every other chunk keeps its hash.
+#
+
+import hashlib
+
+# A 32 bit fingerprint stays a machine sized integer, which keeps the per byte loop fast.
+FINGERPRINT_BITS = 32
+FINGERPRINT_MASK = (1 << FINGERPRINT_BITS) - 1
+
+# One pseudo random value per byte value, derived from md5 so it is the same everywhere.
+GEAR = [int(hashlib.md5(str(byte).encode('ascii')).hexdigest()[:8], 16) for byte in range(256)]
+
+
+#
+# A mask with the given number of bits set, taken from the top of the hash where
+# each bit depends on the most bytes.
+def make_mask(bits):
+    return ((1 << bits) - 1) << (FINGERPRINT_BITS - bits)
+
+
+class Chunker:
+    def __init__(self, min_size=16 * 1024, average_size=64 * 1024, max_size=256 * 1024):
+        if not min_size <= average_size <= max_size:
+            raise ValueError('chunk sizes must satisfy min <= average <= max')
+
+        self.min_size = min_size
+        self.average_size = average_size
+        self.max_size = max_size
+
+        # Normalised chunking: a harder mask before the average size and an easier
+        # one after it keeps chunk sizes close to the average.
+        bits = max(average_size.bit_length() - 1, 2)
+        self.small_mask = make_mask(bits + 1)
+        self.large_mask = make_mask(bits - 1)
+
+    #
+    # Return the length of the chunk starting at data[start:end].
+    def find_cut(self, data, start, end):
+        length = end - start
+
+        if length <= self.min_size:
+            return length
+
+        limit = min(length, self.max_size)
+        normal = min(limit, self.average_size)
+        gear = GEAR
+        fingerprint = 0
+
+        # Cut points are never looked for inside the minimum size.
+        position = start + self.min_size
+
+        # Iterating over a slice is much faster than indexing byte by byte.
+        mask = self.small_mask
+        for byte in data[position:start + normal]:
+            fingerprint = ((fingerprint << 1) + gear[byte]) & FINGERPRINT_MASK
+            position += 1
+            if not fingerprint & mask:
+                return position - start
+
+        mask = self.large_mask
+        for byte in data[position:start + limit]:
+            fingerprint = ((fingerprint << 1) + gear[byte]) & FINGERPRINT_MASK
+            position += 1
+            if not fingerprint & mask:
+                return position - start
+
+        return limit
+
+    #
+    # Split a stream, given as an iterable of byte strings, into chunks. The chunks
+    # do not depend on how the stream is split into byte strings. Each byte is copied
+    # into the pending buffer once and out into its chunk once: cutting only moves a
+    # position along, and what has been cut is dropped once per byte string.
+    def chunks(self, buffers):
+        pending = bytearray()
+        start = 0
+
+        for buffer in buffers:
+            del pending[:start]
+            start = 0
+            pending.extend(buffer)
+
+            while len(pending) - start >= self.max_size:
+                cut = self.find_cut(pending, start, len(pending))
+                yield memoryview(pending)[start:start + cut].tobytes()
+                start += cut
+
+        while start < len(pending):
+            cut = self.find_cut(pending, start, len(pending))
+            yield memoryview(pending)[start:start + cut].tobytes()
+            start += cut
@@ -0,0 +1,208 @@
+#
+# @file  collector.py
+#
+# @brief Background garbage collector. Stored blocks that no Block row refers to, left
+#        behind by a crash between an upload and its commit or by a delete that failed,
+#        are found by listing every block directory and comparing it with the metadata,
+#        and deleted once two passes in a row have found them. Block rows nothing reads
+#        any more are compacted away first. Driver calls are paced to a few a second and
+#        run behind everything else.
+#
+
+import logging
+import re
+import threading
+import time
+
+import drivers.scheduled
+
+log = logging.getLogger('cloud-fuse')
+
+# Stored blocks are named after the md5 of their contents. Anything else found in a block directory is left alone.
+BLOCK_NAME = re.compile(r'^[0-9a-f]{32}$')
+# Blocks are spread over one directory for each of these prefixes of their hash.
+PREFIXES = ['{:02x}'.format(number) for number in range(256)]
+# Orphaned blocks named in a report, the rest are only counted.
+REPORTED_ORPHANS = 1000
+# Seconds after start() before the first pass, so that it does not compete with mounting.
+FIRST_PASS_DELAY = 5 * 60
+# Orphans only come from crashes and failed deletes, so a pass that finds more than this
+# fraction of the stored blocks orphaned, beyond a few, is looking at the wrong metadata
+# and deletes nothing.
+MAX_ORPHANED_FRACTION = 0.1
+ORPHAN_ALLOWANCE = 100
+
+
+class GarbageCollector:
+    # list_directory(prefix) returns the names stored in the block directory for a prefix,
+    # or False if it could not be listed. find_referenced(prefix) returns the hashes starting
+    # with prefix that Block rows refer to. release(block_hash) deletes a stored block unless
+    # something refers to it by then, returning whether it did. compact(dry_run) deletes the
+    # Block rows nothing reads any more, returning how many there were and the hashes they
+    # referred to. has_blocks() returns whether there are any Block rows at all. The orphans
+    # a pass found are given to save_suspects(hashes), and load_suspects() returns them
+    # for the next pass, which only deletes those it finds again. At most rate driver calls
+    # are made a second, any number without a rate, and with dry_run nothing is deleted,
+    # only reported.
+    def __init__(self, list_directory, find_referenced, release, compact, has_blocks, load_suspects,
+                 save_suspects, rate=2.0, dry_run=False):
+        self.list_directory = list_directory
+        self.find_referenced = find_referenced
+        self.release = release
+        self.compact = compact
+        self.has_blocks = has_blocks
+        self.load_suspects = load_suspects
+        self.save_suspects = save_suspects
+        self.dry_run = dry_run
+        self.bucket = drivers.scheduled.TokenBucket(rate or None, burst=1)
+
+        self.passes = 0
+        self.last_report = None
+        self.thread = None
+        self.stopped = threading.Event()
+        # Only one pass runs at a time.
+        self.lock = threading.Lock()
+
+    #
+    # Make a pass every interval seconds in a background thread.
+    def start(self, interval):
+        def collect():
+            delay = min(FIRST_PASS_DELAY, interval)
+
+            while not self.stopped.wait(delay):
+                try:
+                    self.run()
+                except Exception:
+                    log.exception("Garbage collection failed")
+
+                delay = interval
+
+        self.thread = threading.Thread(target=collect, name='garbage-collector')
+        self.thread.daemon = True
+        self.thread.start()
+
+    #
+    # Wait for the next driver call to be allowed, returning False if the collector was stopped meanwhile.
+    def pace(self):
+        delay = self.bucket.take()
+
+        return not self.stopped.wait(delay) if delay > 0 else not self.stopped.is_set()
+
+    #
+    # Make one pass, returning a report of what was found and what was done about it.
+    def run(self):
+        with self.lock, drivers.scheduled.priority(drivers.scheduled.BACKGROUND):
+            start = time.time()
+            report = dict(dry_run=self.dry_run, compacted_rows=0, released=0, directories=0, unlisted_directories=0,
+                          stored=0, ignored=0, orphaned=0, confirmed=0, deleted=0, refused=None, orphans=[])
+
+            # Without any rows every stored block looks orphaned, as it does with a new or lost database.
+            if not self.has_blocks():
+                return self.finish(report, start, "there are no block rows")
+
+            compacted_rows, block_hashes = self.compact(self.dry_run)
+            report['compacted_rows'] = compacted_rows
+
+            # Blocks still shared with other rows are kept by release, which knows.
+            if not self.dry_run:
+                for block_hash in block_hashes:
+                    if not self.pace():
+                        break
+
+                    if self.release(block_hash):
+                        report['released'] += 1
+
+            suspects = self.load_suspects()
+            orphans = set()
+            complete = True
+
+            for prefix in PREFIXES:
+                if not self.pace():
+                    complete = False
+                    break
+
+                names = self.list_directory(prefix)
+                if names is False:
+                    # A directory that is missing, or that could not be listed, may hold nothing or anything.
+                    report['unlisted_directories'] += 1
+                    continue
+
+                report['directories'] += 1
+
+                # Listing first means any block uploaded after find_referenced was already
+                # pinned by its flush or referenced, which release checks again anyway.
+                referenced = self.find_referenced(prefix)
+
+                for name in names:
+                    if not BLOCK_NAME.match(name):
+                        report['ignored'] += 1
+                        continue
+
+                    report['stored'] += 1
+                    if name in referenced:
+                        continue
+
+                    report['orphaned'] += 1
+                    if len(report['orphans']) < REPORTED_ORPHANS:
+                        report['orphans'].append(name)
+
+                    # Past the limit the pass is most likely refused, so the names are not kept.
+                    if report['orphaned'] <= self.orphan_limit(report['stored']):
+                        orphans.add(name)
+
+            if report['orphaned'] > self.orphan_limit(report['stored']):
+                self.save_suspects(set())
+                return self.finish(report, start, "{} of {} stored blocks are orphaned".format(
+                    report['orphaned'], report['stored']))
+
+            confirmed = orphans & suspects
+            report['confirmed'] = len(confirmed)
+
+            if not self.dry_run and complete:
+                for name in sorted(confirmed):
+                    if not self.pace():
+                        break
+
+                    if self.release(name):
+                        report['deleted'] += 1
+                        orphans.discard(name)
+
+            # A pass cut short does not know what the rest of the directories hold.
+            if complete:
+                self.save_suspects(orphans)
+
+            return self.finish(report, start)
+
+    def orphan_limit(self, stored):
+        return max(ORPHAN_ALLOWANCE, stored * MAX_ORPHANED_FRACTION)
+
+    def finish(self, report, start, refused=None):
+        report['seconds'] = time.time() - start
+
+        if refused:
+            report['refused'] = refused
+            log.error("Garbage collection deleted nothing, as %s", refused)
+        else:
+            log.info("Garbage collection %s %d of %d stored blocks and %d block rows, released %d blocks",
+                     "found" if self.dry_run else "deleted", report['confirmed' if self.dry_run else 'deleted'],
+                     report['stored'], report['compacted_rows'], report['released'])
+
+        self.passes += 1
+        self.last_report = report
+
+        return report
+
+    #
+    # Stop the background thread, cutting short a pass that is under way.
+    def close(self):
+        self.stopped.set()
+
+        if self.thread:
+            self.thread.join()
+
+    def stats(self):
+        report = self.last_report
+        if report is not None:
+            report = dict((key, value) for key, value in report.items() if key != 'orphans')
+
+        return dict(passes=self.passes, dry_run=self.dry_run, last_pass=report)
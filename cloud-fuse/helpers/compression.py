@@ -0,0 +1,66 @@
+#
+# @file  compression.py
+#
+# @brief Per block compression codecs. The codec used is recorded on each block so that
+#        blocks written with different codecs can be read back side by side.
+#
+
+import zlib
+
+# Codec name -> (compress, decompress).
+codecs = {
+    'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+}
+
+try:
+    import lz4.frame
+    codecs['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+try:
+    import zstandard
+    codecs['zstd'] = (lambda data: zstandard.ZstdCompressor().compress(data),
+                      lambda data: zstandard.ZstdDecompressor().decompress(data))
+except ImportError:
+    pass
+
+RAW = 'raw'
+
+# Compressing must save at least this fraction of the block for it to be worth storing compressed.
+MINIMUM_SAVING = 0.1
+SAMPLE_SIZE = 4096
+
+
+def available_codecs():
+    return [RAW] + sorted(codecs)
+
+
+#
+# Return (codec, stored contents). Blocks that do not compress well are returned
+# unchanged with the raw codec. Large blocks are judged on a sample first, so
+# incompressible data costs one small compression rather than a full one.
+def compress(data, codec):
+    if not codec or codec == RAW or not data:
+        return RAW, data
+
+    compress_function = codecs[codec][0]
+
+    if len(data) > SAMPLE_SIZE * 2:
+        sample = data[:SAMPLE_SIZE]
+        if len(compress_function(sample)) > len(sample) * (1 - MINIMUM_SAVING):
+            return RAW, data
+
+    compressed = compress_function(data)
+
+    if len(compressed) > len(data) * (1 - MINIMUM_SAVING):
+        return RAW, data
+
+    return codec, compressed
+
+
+def decompress(data, codec):
+    if not codec or codec == RAW or not data:
+        return data
+
+    return codecs[codec][1](data)
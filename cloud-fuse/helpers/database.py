@@ -1,3 +1,63 @@
-from sqlalchemy                 import Column, String, Integer, ForeignKey, create_engine
+from sqlalchemy                 import Column, String, Integer, ForeignKey, create_engine, event, inspect, text
 from sqlalchemy.orm             import relationship, backref, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+
+
+#
+# create_all only creates tables that are missing, so add any columns and indexes
+# that were introduced after the database was first created. Returns the added
+# columns as "table.column" strings.
+def upgrade_schema(engine, metadata):
+    inspector = inspect(engine)
+    added_columns = []
+
+    for table in metadata.sorted_tables:
+        existing_columns = set(column['name'] for column in inspector.get_columns(table.name))
+
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+
+            print("Adding column {}.{}".format(table.name, column.name))
+            engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table.name, column.name,
+                                                                    column.type.compile(engine.dialect)))
+            added_columns.append('{}.{}'.format(table.name, column.name))
+
+        existing_indexes = set(index['name'] for index in inspector.get_indexes(table.name))
+
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                print("Adding index {}".format(index.name))
+                index.create(engine)
+
+    return added_columns
+
+
+#
+# Run SQLite in write-ahead log mode with a normal sync level. A commit then only
+# appends to the log, which is synced when it is checkpointed, so the metadata
+# commits in between share one fsync instead of paying for one each.
+def configure_sqlite(engine):
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(connection, connection_record):
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+
+#
+# Sync the write-ahead log and copy it into the database, so that every commit so far is durable.
+def checkpoint(engine):
+    engine.execute(text('PRAGMA wal_checkpoint(PASSIVE)'))
+
+
+#
+# The version of the data in the database, as opposed to its schema, kept in SQLite's user_version.
+# It is only bumped once the data has been upgraded, so an upgrade that fails is tried again.
+def get_data_version(engine):
+    return engine.execute(text('PRAGMA user_version')).scalar()
+
+
+def set_data_version(engine, version):
+    engine.execute(text('PRAGMA user_version = {}'.format(int(version))))
@@ -0,0 +1,200 @@
+#
+# @file  dentry.py
+#
+# @brief In-memory cache of path lookups, so that resolving a hot path does not touch the database.
+#
+
+import collections
+import threading
+
+
+class DentryCache:
+    def __init__(self, max_entries=65536):
+        self.max_entries = max_entries
+
+        # Full path -> node id, or None for a path that is known not to exist.
+        self.paths = collections.OrderedDict()
+        # (parent id, name) -> node id, or None. The root directory has a parent id of None.
+        self.entries = collections.OrderedDict()
+        # Directory path -> the cached paths directly below it, and the directories leading to the
+        # ones further down, so that forgetting a subtree only visits what is cached inside it.
+        self.children = {}
+        # Node id -> keys of the entries for that node and for the names in it, if it is a directory.
+        self.entry_keys = {}
+        # Node objects belong to the session of the thread that loaded them, so each thread
+        # keeps its own node id -> (node, version) map. Holding a reference keeps the node
+        # in that session's identity map.
+        self.local = threading.local()
+        # Node id -> version, bumped whenever a node is changed so other threads refresh their copy.
+        self.node_versions = {}
+
+        self.lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+
+    #
+    # Return (True, node id) if the path is cached - the id is None for a negative
+    # entry - or (False, None) if it has to be looked up.
+    def get_path(self, path):
+        return self.get(self.paths, path)
+
+    def put_path(self, path, node_id):
+        with self.lock:
+            for evicted_path, evicted_id in self.put(self.paths, path, node_id):
+                self.unlink_path(evicted_path)
+
+            while path:
+                parent = path.rsplit('/', 1)[0]
+                siblings = self.children.setdefault(parent, set())
+                if path in siblings:
+                    break
+
+                siblings.add(path)
+                path = parent
+
+    def get_entry(self, parent_id, name):
+        return self.get(self.entries, (parent_id, name))
+
+    def put_entry(self, parent_id, name, node_id):
+        key = (parent_id, name)
+
+        with self.lock:
+            # A name may now refer to another node than before.
+            self.drop_entry(key)
+
+            for evicted_key, evicted_id in self.put(self.entries, key, node_id):
+                self.unindex_entry(evicted_key[0], evicted_key)
+                self.unindex_entry(evicted_id, evicted_key)
+
+            self.entry_keys.setdefault(parent_id, set()).add(key)
+            if node_id is not None:
+                self.entry_keys.setdefault(node_id, set()).add(key)
+
+    #
+    # Return (node, current) for a node loaded by this thread, where current is False if
+    # another thread has changed the node since, or (None, False) if it is not cached.
+    def get_node(self, node_id):
+        nodes = self.get_thread_nodes()
+        cached = nodes.get(node_id)
+
+        if cached is None:
+            return None, False
+
+        nodes[node_id] = nodes.pop(node_id)
+        node, version = cached
+
+        return node, version == self.node_versions.get(node_id, 0)
+
+    def put_node(self, node):
+        self.put(self.get_thread_nodes(), node.id, (node, self.node_versions.get(node.id, 0)))
+
+    def get_thread_nodes(self):
+        if not hasattr(self.local, 'nodes'):
+            self.local.nodes = collections.OrderedDict()
+
+        return self.local.nodes
+
+    def touch_node(self, node_id):
+        with self.lock:
+            self.node_versions[node_id] = self.node_versions.get(node_id, 0) + 1
+
+    #
+    # Forget a path, everything below it, and its entry in the parent directory.
+    def invalidate(self, path, parent_id=None, name=None):
+        path = path.rstrip('/')
+
+        with self.lock:
+            below = [path]
+            while below:
+                cached_path = below.pop()
+                self.paths.pop(cached_path, None)
+                below.extend(self.children.pop(cached_path, ()))
+
+            self.unlink_path(path)
+
+            if name is not None:
+                self.drop_entry((parent_id, name))
+
+    def invalidate_node(self, node_id):
+        with self.lock:
+            self.get_thread_nodes().pop(node_id, None)
+            self.touch_node(node_id)
+
+            for key in list(self.entry_keys.get(node_id, ())):
+                self.drop_entry(key)
+
+    def clear(self):
+        with self.lock:
+            self.paths.clear()
+            self.children.clear()
+            self.entries.clear()
+            self.entry_keys.clear()
+            self.get_thread_nodes().clear()
+
+    #
+    # Take a path that is no longer cached out of the directory index, along with any
+    # directories above it that no longer lead to a cached path. Called with the lock held.
+    def unlink_path(self, path):
+        while path and path not in self.paths and not self.children.get(path):
+            self.children.pop(path, None)
+            parent = path.rsplit('/', 1)[0]
+            siblings = self.children.get(parent)
+            if siblings is None:
+                break
+
+            siblings.discard(path)
+            path = parent
+
+    #
+    # Forget an entry and take it out of the node index. Called with the lock held.
+    def drop_entry(self, key):
+        if key not in self.entries:
+            return
+
+        node_id = self.entries.pop(key)
+        self.unindex_entry(key[0], key)
+        self.unindex_entry(node_id, key)
+
+    def unindex_entry(self, node_id, key):
+        keys = self.entry_keys.get(node_id)
+        if keys is None:
+            return
+
+        keys.discard(key)
+        if not keys:
+            del self.entry_keys[node_id]
+
+    def get(self, cache, key):
+        with self.lock:
+            if key not in cache:
+                self.misses += 1
+                return False, None
+
+            self.hits += 1
+            value = cache.pop(key)
+            cache[key] = value
+
+            return True, value
+
+    #
+    # Returns the (key, value) pairs that were evicted to make room.
+    def put(self, cache, key, value):
+        evicted = []
+
+        with self.lock:
+            cache.pop(key, None)
+            cache[key] = value
+
+            while len(cache) > self.max_entries:
+                evicted.append(cache.popitem(last=False))
+
+        return evicted
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            paths=len(self.paths),
+            entries=len(self.entries)
+        )
@@ -0,0 +1,405 @@
+#
+# @file  journal.py
+#
+# @brief Local journal of blocks waiting to be uploaded. A block appended to the journal is as
+#        good as stored for the application, and worker threads upload it in the background.
+#        Until then it is read back from the journal, and blocks a crash left behind are
+#        uploaded after the next mount.
+#
+
+import collections
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+log = logging.getLogger('cloud-fuse')
+
+# Record kinds: a block to upload, and a block that has been uploaded or is no longer wanted.
+APPEND = 1
+DONE = 2
+
+# Kind, name length and contents length, followed by the name, the contents and a crc32 of all of it.
+HEADER = struct.Struct('>BHI')
+CHECKSUM = struct.Struct('>I')
+
+SEGMENT_PREFIX = 'journal-'
+SEGMENT_SUFFIX = '.log'
+
+
+class Entry:
+    def __init__(self, name, segment, offset, length):
+        self.name = name
+        # Where the contents are: segment number and offset within it.
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+        self.attempts = 0
+
+
+#
+# Read every complete record from a segment file, yielding (kind, name, contents offset,
+# contents length). A record torn by a crash ends the segment.
+def read_records(segment_file):
+    offset = 0
+
+    while True:
+        header = segment_file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return
+
+        kind, name_length, length = HEADER.unpack(header)
+        name = segment_file.read(name_length)
+        contents = segment_file.read(length)
+        checksum = segment_file.read(CHECKSUM.size)
+
+        if len(checksum) < CHECKSUM.size or \
+                CHECKSUM.unpack(checksum)[0] != zlib.crc32(contents, zlib.crc32(header + name)) & 0xffffffff:
+            return
+
+        yield kind, name.decode('utf-8'), offset + HEADER.size + name_length, length
+        offset += HEADER.size + name_length + length + CHECKSUM.size
+
+
+class UploadJournal:
+    # upload(name, contents) stores a block on the driver and returns whether it worked.
+    # Appending waits while more than max_bytes are waiting to be uploaded. A new segment
+    # file is started every segment_size bytes, and segments are deleted once every
+    # block in them has been uploaded.
+    def __init__(self, directory, upload, workers=4, max_bytes=1024 * 1024 * 1024, segment_size=64 * 1024 * 1024,
+                 retry_delay=5.0):
+        self.directory = directory
+        self.upload = upload
+        self.max_bytes = max_bytes
+        self.segment_size = segment_size
+        self.retry_delay = retry_delay
+
+        # Name -> Entry of every block still to be uploaded, and the order to upload them in.
+        self.entries = {}
+        self.queue = collections.deque()
+        # Names being uploaded right now.
+        self.uploading = set()
+        # Segment number -> blocks in it still to be uploaded.
+        self.live = collections.Counter()
+        # Segment number -> read descriptor.
+        self.descriptors = {}
+        self.pending_bytes = 0
+        # Records written, and how many of them the last fsync made durable. A sync that
+        # finds an fsync under way waits for it, then only makes another if it is still behind.
+        self.written = 0
+        self.synced = 0
+        self.syncing = False
+
+        self.uploaded = 0
+        self.failed = 0
+        self.replayed = 0
+
+        self.closed = False
+        self.condition = threading.Condition()
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.replay()
+
+        self.workers = []
+        for worker_number in range(workers):
+            worker = threading.Thread(target=self.work, name='journal-{}'.format(worker_number))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def get_segment_path(self, segment):
+        return os.path.join(self.directory, '{}{:08d}{}'.format(SEGMENT_PREFIX, segment, SEGMENT_SUFFIX))
+
+    #
+    # Rebuild the blocks still to be uploaded from the segments on disk. Appending always
+    # starts a new segment, so a torn record is never written after.
+    def replay(self):
+        segments = sorted(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                          if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+
+        for segment in segments:
+            with open(self.get_segment_path(segment), 'rb') as segment_file:
+                for kind, name, offset, length in read_records(segment_file):
+                    if kind == APPEND and name not in self.entries:
+                        self.add_entry(Entry(name, segment, offset, length))
+                    elif kind == DONE and name in self.entries:
+                        self.remove_entry(self.entries[name])
+
+        self.replayed = len(self.entries)
+        if self.replayed:
+            log.info("Resuming the upload of %d blocks left in the journal", self.replayed)
+
+        self.segment = (segments[-1] + 1) if segments else 1
+        self.segment_fd = None
+        self.segment_offset = 0
+        self.open_segment()
+
+        for segment in segments:
+            self.delete_segment_if_done(segment)
+
+    #
+    # Start a new segment. The one before is synced first, so that a sync only ever needs the current one.
+    def open_segment(self):
+        if self.segment_fd is not None:
+            while self.syncing:
+                self.condition.wait()
+
+            if self.synced < self.written:
+                os.fsync(self.segment_fd)
+                self.synced = self.written
+
+            os.close(self.segment_fd)
+
+        self.segment_fd = os.open(self.get_segment_path(self.segment),
+                                  os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, 'O_BINARY', 0), 0o600)
+        self.segment_offset = 0
+
+    # The methods below that change the entries are called with the condition held.
+    def add_entry(self, entry):
+        self.entries[entry.name] = entry
+        self.queue.append(entry)
+        self.live[entry.segment] += 1
+        self.pending_bytes += entry.length
+
+    def remove_entry(self, entry):
+        del self.entries[entry.name]
+        self.live[entry.segment] -= 1
+        self.pending_bytes -= entry.length
+
+    def delete_segment_if_done(self, segment):
+        if segment == self.segment or self.live[segment] > 0:
+            return
+
+        del self.live[segment]
+
+        descriptor = self.descriptors.pop(segment, None)
+        if descriptor is not None:
+            os.close(descriptor)
+
+        try:
+            os.remove(self.get_segment_path(segment))
+        except OSError:
+            pass
+
+    #
+    # Append a record to the current segment, returning the offset of its contents.
+    def write_record(self, kind, name, contents=b""):
+        if self.segment_offset >= self.segment_size:
+            self.segment += 1
+            self.open_segment()
+            self.delete_segment_if_done(self.segment - 1)
+
+        encoded_name = name.encode('utf-8')
+        header = HEADER.pack(kind, len(encoded_name), len(contents)) + encoded_name
+        checksum = CHECKSUM.pack(zlib.crc32(contents, zlib.crc32(header)) & 0xffffffff)
+
+        try:
+            for data in (header, contents, checksum):
+                data = memoryview(data)
+                written = 0
+
+                while written < len(data):
+                    written += os.write(self.segment_fd, data[written:])
+        except OSError:
+            # Cut off what was written of the record, which would hide every record after it.
+            os.ftruncate(self.segment_fd, self.segment_offset)
+            raise
+
+        offset = self.segment_offset + len(header)
+        self.segment_offset += len(header) + len(contents) + len(checksum)
+        self.written += 1
+
+        return offset
+
+    #
+    # Add a block, given as bytes, to upload. Once this returns the block survives a crash
+    # of this process, though not of the machine until sync(), which must come before
+    # anything that refers to the block is committed. A block that is already waiting is
+    # not added again.
+    def append(self, name, contents):
+        with self.condition:
+            while self.pending_bytes and self.pending_bytes + len(contents) > self.max_bytes and not self.closed:
+                self.condition.wait()
+
+            if name in self.entries:
+                return
+
+            offset = self.write_record(APPEND, name, contents)
+            self.add_entry(Entry(name, self.segment, offset, len(contents)))
+            self.condition.notify_all()
+
+    #
+    # Return the contents of a block that is still waiting to be uploaded, or None.
+    def read(self, name):
+        with self.condition:
+            entry = self.entries.get(name)
+            if entry is None:
+                return None
+
+            descriptor = self.descriptors.get(entry.segment)
+            if descriptor is None:
+                descriptor = self.descriptors[entry.segment] = os.open(self.get_segment_path(entry.segment),
+                                                                       os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+
+            os.lseek(descriptor, entry.offset, os.SEEK_SET)
+            parts = []
+            done = 0
+
+            while done < entry.length:
+                part = os.read(descriptor, entry.length - done)
+                if not part:
+                    break
+
+                parts.append(part)
+                done += len(part)
+
+            return b"".join(parts)
+
+    #
+    # Stop uploading a block, once an upload of it already under way has finished.
+    # Returns whether it was still waiting.
+    def discard(self, name):
+        with self.condition:
+            while name in self.uploading:
+                self.condition.wait()
+
+            entry = self.entries.get(name)
+            if entry is None:
+                return False
+
+            self.write_record(DONE, name)
+            self.remove_entry(entry)
+            self.delete_segment_if_done(entry.segment)
+            self.condition.notify_all()
+
+            return True
+
+    #
+    # Make everything appended so far survive a crash of the machine. Blocks appended by
+    # several flushes at once are made durable by a single fsync.
+    def sync(self):
+        with self.condition:
+            target = self.written
+
+            while self.syncing and self.synced < target:
+                self.condition.wait()
+
+            if self.synced >= target:
+                return
+
+            self.syncing = True
+            descriptor = self.segment_fd
+
+        try:
+            os.fsync(descriptor)
+        finally:
+            with self.condition:
+                self.syncing = False
+                self.synced = max(self.synced, target)
+                self.condition.notify_all()
+
+    #
+    # Wait until every block has been uploaded, or timeout seconds have passed.
+    # Returns whether the journal is empty.
+    def drain(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+
+        with self.condition:
+            while self.entries and not self.closed:
+                if deadline is not None and time.time() >= deadline:
+                    break
+
+                self.condition.wait(1.0)
+
+            return not self.entries
+
+    def next_upload(self):
+        with self.condition:
+            while not self.closed:
+                while self.queue:
+                    entry = self.queue.popleft()
+
+                    # A block discarded, or uploaded and appended again, leaves a stale entry behind.
+                    if self.entries.get(entry.name) is entry:
+                        self.uploading.add(entry.name)
+                        return entry
+
+                self.condition.wait()
+
+            return None
+
+    def work(self):
+        while True:
+            entry = self.next_upload()
+            if entry is None:
+                return
+
+            try:
+                contents = self.read(entry.name)
+                uploaded = contents is not None and self.upload(entry.name, contents)
+            except Exception:
+                log.exception("Uploading %s from the journal failed", entry.name)
+                uploaded = False
+
+            with self.condition:
+                self.uploading.discard(entry.name)
+
+                if uploaded:
+                    self.uploaded += 1
+                    self.write_record(DONE, entry.name)
+                    self.remove_entry(entry)
+                    self.delete_segment_if_done(entry.segment)
+                else:
+                    self.failed += 1
+                    entry.attempts += 1
+
+                self.condition.notify_all()
+
+            if not uploaded:
+                log.warning("Could not upload %s from the journal, trying again in %d seconds",
+                            entry.name, self.retry_delay)
+                # Other blocks go first while this one waits, unless the journal is closed.
+                retry_time = time.time() + self.retry_delay
+
+                with self.condition:
+                    while not self.closed and time.time() < retry_time:
+                        self.condition.wait(retry_time - time.time())
+
+                    if self.entries.get(entry.name) is entry:
+                        self.queue.append(entry)
+                        self.condition.notify_all()
+
+    #
+    # Stop the workers. Blocks not uploaded yet stay in the journal for the next mount.
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        for worker in self.workers:
+            worker.join()
+
+        with self.condition:
+            os.fsync(self.segment_fd)
+            os.close(self.segment_fd)
+            self.segment_fd = None
+
+            for descriptor in self.descriptors.values():
+                os.close(descriptor)
+            self.descriptors = {}
+
+    def stats(self):
+        with self.condition:
+            return dict(
+                pending=len(self.entries),
+                pending_bytes=self.pending_bytes,
+                uploading=len(self.uploading),
+                uploaded=self.uploaded,
+                failed=self.failed,
+                replayed=self.replayed,
+                segments=len(set(self.live) | set([self.segment]))
+            )
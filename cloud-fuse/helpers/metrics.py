@@ -0,0 +1,188 @@
+#
+# @file  metrics.py
+#
+# @brief Cheap runtime metrics: latency histograms per FUSE operation, driver call statistics and
+#        SQL statements per operation, readable as JSON through a local socket.
+#
+
+import json
+import os
+import socket
+import threading
+import time
+
+
+# Latencies are counted in power of two buckets of microseconds, the last bucket takes everything above.
+BUCKET_COUNT = 28
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.buckets[min(int(seconds * 1000000).bit_length(), BUCKET_COUNT - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    #
+    # Estimate a percentile as the upper bound of the bucket it falls in.
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+
+        wanted = fraction * self.count
+        seen = 0
+
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= wanted:
+                return min((1 << bucket) / 1000000.0, self.max)
+
+        return self.max
+
+    def snapshot(self):
+        return dict(
+            count=self.count,
+            mean=self.total / self.count if self.count else None,
+            p50=self.percentile(0.5),
+            p90=self.percentile(0.9),
+            p99=self.percentile(0.99),
+            max=self.max,
+            # Upper bound in microseconds -> count, leaving out empty buckets.
+            buckets=dict((str(1 << bucket), count) for bucket, count in enumerate(self.buckets) if count)
+        )
+
+
+class CallStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.latency = Histogram()
+
+    def snapshot(self):
+        return dict(calls=self.calls, errors=self.errors, retries=self.retries, bytes=self.bytes,
+                    latency=self.latency.snapshot())
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+        # FUSE operation -> Histogram.
+        self.operations = {}
+        # FUSE operation -> number of SQL statements run while handling it.
+        self.queries = {}
+        # (driver, call) -> CallStats.
+        self.driver_calls = {}
+
+        # The operation each thread is handling, so SQL statements can be charged to it.
+        self.local = threading.local()
+
+    def begin_operation(self, operation):
+        self.local.operation = operation
+
+    def end_operation(self, operation, seconds):
+        self.local.operation = None
+
+        with self.lock:
+            histogram = self.operations.get(operation)
+            if histogram is None:
+                histogram = self.operations[operation] = Histogram()
+
+            histogram.record(seconds)
+
+    def count_query(self, *args):
+        operation = getattr(self.local, 'operation', None) or 'background'
+
+        with self.lock:
+            self.queries[operation] = self.queries.get(operation, 0) + 1
+
+    #
+    # Count every SQL statement the engine runs.
+    def watch_engine(self, engine):
+        from sqlalchemy import event
+
+        event.listen(engine, 'before_cursor_execute', self.count_query)
+
+    def get_call_stats(self, driver, call):
+        stats = self.driver_calls.get((driver, call))
+        if stats is None:
+            stats = self.driver_calls[driver, call] = CallStats()
+
+        return stats
+
+    def record_call(self, driver, call, seconds, size=0, failed=False):
+        with self.lock:
+            stats = self.get_call_stats(driver, call)
+            stats.calls += 1
+            stats.bytes += size
+            stats.latency.record(seconds)
+            if failed:
+                stats.errors += 1
+
+    def record_retry(self, driver, call):
+        with self.lock:
+            self.get_call_stats(driver, call).retries += 1
+
+    def snapshot(self):
+        with self.lock:
+            drivers = {}
+            for (driver, call), stats in self.driver_calls.items():
+                drivers.setdefault(driver, {})[call] = stats.snapshot()
+
+            return dict(
+                uptime=time.time() - self.started,
+                operations=dict((operation, histogram.snapshot())
+                                for operation, histogram in self.operations.items()),
+                queries=dict(self.queries),
+                drivers=drivers
+            )
+
+
+#
+# Serves the JSON of get_snapshot() to every client that connects to a unix
+# socket, for example with `socat - UNIX-CONNECT:path`.
+class MetricsServer:
+    def __init__(self, get_snapshot, path):
+        self.get_snapshot = get_snapshot
+        self.path = path
+
+        if os.path.exists(path):
+            os.remove(path)
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(4)
+
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                client, address = self.listener.accept()
+            except socket.error:
+                return
+
+            try:
+                snapshot = json.dumps(self.get_snapshot(), indent=2, sort_keys=True) + '\n'
+                client.sendall(snapshot.encode('utf-8'))
+            except socket.error:
+                pass
+            finally:
+                client.close()
+
+    def close(self):
+        self.listener.close()
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
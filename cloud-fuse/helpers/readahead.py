@@ -0,0 +1,136 @@
+#
+# @file  readahead.py
+#
+# @brief Sequential access detection and background prefetching of blocks for a single open file.
+#
+
+import threading
+
+
+class ReadAhead:
+    def __init__(self, fetch_block, initial_window=2, max_window=32, submit=None):
+        # fetch_block(index) is called from background threads and must not touch the database session.
+        self.fetch_block = fetch_block
+        # Used to run prefetches, a new thread is started for each one when it is not given.
+        self.submit = submit
+        self.initial_window = initial_window
+        self.max_window = max_window
+
+        self.window = 0
+        self.last_block = None
+
+        # Block index -> contents, for blocks that have been fetched ahead of the reader.
+        self.prefetched = {}
+        # Block index -> Event, for fetches that are still in flight.
+        self.pending = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    #
+    # Record a read covering blocks first_block..last_block and, if the file is
+    # being read sequentially, start fetching the blocks that will be needed next,
+    # never going past block_limit when it is given.
+    def access(self, first_block, last_block, block_limit=None):
+        with self.lock:
+            sequential = self.last_block is not None and self.last_block <= first_block <= self.last_block + 1
+
+            if sequential:
+                # Only grow the window when the reader moves on to a new block, so many small
+                # reads inside one block do not inflate it.
+                if last_block > self.last_block or not self.window:
+                    self.window = min(max(self.window * 2, self.initial_window), self.max_window)
+            else:
+                # Random access - stop prefetching and forget anything we fetched.
+                self.window = 0
+                self.prefetched.clear()
+
+            self.last_block = last_block
+
+            # Anything behind the reader will not be asked for again.
+            for index in [index for index in self.prefetched if index < first_block]:
+                del self.prefetched[index]
+
+            fetch_end = last_block + 1 + self.window
+            if block_limit is not None:
+                fetch_end = min(fetch_end, block_limit + 1)
+
+            to_fetch = [index for index in range(last_block + 1, fetch_end)
+                        if index not in self.prefetched and index not in self.pending]
+
+            for index in to_fetch:
+                self.pending[index] = threading.Event()
+
+            started = [(index, self.pending[index]) for index in to_fetch]
+
+        for index, event in started:
+            if self.submit:
+                self.submit(self.prefetch, index, event)
+                continue
+
+            fetch_thread = threading.Thread(target=self.prefetch, args=(index, event))
+            fetch_thread.daemon = True
+            fetch_thread.start()
+
+    def prefetch(self, index, event):
+        try:
+            contents = self.fetch_block(index)
+        except Exception:
+            contents = False
+
+        with self.lock:
+            # The fetch may have been invalidated while it was in flight.
+            if self.pending.get(index) is event:
+                del self.pending[index]
+                if contents and self.window:
+                    self.prefetched[index] = contents
+
+        event.set()
+
+    #
+    # Return a prefetched block, waiting for it if the fetch is already in flight.
+    # Returns None if the block was not prefetched.
+    def get(self, index):
+        with self.lock:
+            event = self.pending.get(index)
+
+        if event is not None:
+            event.wait()
+
+        with self.lock:
+            contents = self.prefetched.get(index)
+
+            if contents is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+            return contents
+
+    #
+    # Drop a block that has been written to, so that a stale copy is never returned.
+    def invalidate(self, index):
+        with self.lock:
+            self.prefetched.pop(index, None)
+            # A fetch that is in flight may return the old contents, so detach it.
+            event = self.pending.pop(index, None)
+
+        if event is not None:
+            event.set()
+
+    #
+    # Drop everything fetched or being fetched, for when the blocks of the file have been renumbered.
+    def reset(self):
+        with self.lock:
+            self.prefetched.clear()
+            events = list(self.pending.values())
+            self.pending.clear()
+
+        for event in events:
+            event.set()
+
+    def close(self):
+        with self.lock:
+            self.window = 0
+            self.prefetched.clear()
@@ -0,0 +1,132 @@
+#
+# @file  trace.py
+#
+# @brief Compact binary trace of FUSE operations, recorded by Context and read back by replay.py.
+#
+# A trace is MAGIC followed by two kinds of entry. A string entry defines the
+# text (an operation name or a path) for a string id. An operation entry
+# refers to its operation and paths by string id, so every path is stored once.
+#
+
+import collections
+import struct
+import threading
+import time
+
+MAGIC = b'CFTRACE1'
+
+STRING_ENTRY = 0
+OPERATION_ENTRY = 1
+
+# Entry type, string id, length of the UTF-8 text that follows.
+STRING = struct.Struct('<BIH')
+# Entry type, operation id, path id, target path id (0 for none), file handle, offset, size,
+# start in seconds from the beginning of the trace, latency in seconds, errno (0 on success).
+OPERATION = struct.Struct('<BIIIQQIdfH')
+
+TraceRecord = collections.namedtuple('TraceRecord',
+                                     'op path target fh offset size start latency error')
+
+
+#
+# Pull (path, target, fh, offset, size) out of the arguments and result of a FUSE operation.
+def describe(op, args, result):
+    path = args[0] if args else None
+    target = None
+    fh = 0
+    offset = 0
+    size = 0
+
+    if op == 'read':
+        size, offset, fh = args[1], args[2], args[3]
+    elif op == 'write':
+        size, offset, fh = len(args[1]), args[2], args[3]
+    elif op == 'truncate':
+        offset = args[1]
+        fh = args[2] if len(args) > 2 else 0
+    elif op in ('open', 'create'):
+        fh = result if isinstance(result, int) else 0
+    elif op in ('release', 'flush', 'readdir'):
+        fh = args[1]
+    elif op == 'fsync':
+        fh = args[2]
+    elif op == 'rename':
+        target = args[1]
+
+    return path, target, fh or 0, offset or 0, size or 0
+
+
+class TraceRecorder:
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+
+        # Text -> string id, ids start at 1 so that 0 can mean none.
+        self.strings = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def get_string_id(self, string):
+        if string is None:
+            return 0
+
+        string_id = self.strings.get(string)
+
+        if string_id is None:
+            string_id = self.strings[string] = len(self.strings) + 1
+            encoded = string if isinstance(string, bytes) else string.encode('utf-8')
+            self.file.write(STRING.pack(STRING_ENTRY, string_id, len(encoded)) + encoded)
+
+        return string_id
+
+    def record(self, op, args, result, start, latency, error=0):
+        path, target, fh, offset, size = describe(op, args, result)
+
+        with self.lock:
+            if self.file is None:
+                return
+
+            self.file.write(OPERATION.pack(OPERATION_ENTRY, self.get_string_id(op), self.get_string_id(path),
+                                           self.get_string_id(target), fh, offset, size,
+                                           start - self.started, latency, error))
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+#
+# Yield a TraceRecord for every operation in a trace file.
+def read_trace(path):
+    strings = {0: None}
+
+    with open(path, 'rb') as trace_file:
+        if trace_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a cloud-fuse trace'.format(path))
+
+        while True:
+            entry_type = trace_file.read(1)
+            if not entry_type:
+                return
+
+            if ord(entry_type) == STRING_ENTRY:
+                entry = entry_type + trace_file.read(STRING.size - 1)
+                if len(entry) < STRING.size:
+                    return
+
+                entry_type, string_id, length = STRING.unpack(entry)
+                strings[string_id] = trace_file.read(length).decode('utf-8')
+                continue
+
+            entry = entry_type + trace_file.read(OPERATION.size - 1)
+            if len(entry) < OPERATION.size:
+                # A trace cut short by a crash ends with a partial entry.
+                return
+
+            (entry_type, op_id, path_id, target_id, fh, offset, size,
+             start, latency, error) = OPERATION.unpack(entry)
+
+            yield TraceRecord(strings[op_id], strings[path_id], strings[target_id], fh, offset, size,
+                              start, latency, error)
@@ -0,0 +1,78 @@
+#
+# @file  transfer.py
+#
+# @brief Bounded pool of worker threads used to run block transfers concurrently.
+#
+
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class Transfer:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+
+        if self.error is not None:
+            raise self.error
+
+        return self.result
+
+
+class TransferPool:
+    # A pool with no workers runs every transfer in the calling thread.
+    def __init__(self, workers=8):
+        self.workers = workers
+        self.queue = queue.Queue()
+        self.local = threading.local()
+
+        for worker_number in range(workers):
+            worker = threading.Thread(target=self.work, name='transfer-{}'.format(worker_number))
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, function, *arguments):
+        transfer = Transfer()
+
+        # Queueing from inside a worker could leave every worker waiting on the queue.
+        if not self.workers or getattr(self.local, 'in_worker', False):
+            self.run(transfer, function, arguments)
+        else:
+            self.queue.put((transfer, function, arguments))
+
+        return transfer
+
+    #
+    # Run function over items concurrently and return the results in order.
+    def map(self, function, items):
+        items = list(items)
+
+        if len(items) == 1:
+            return [function(items[0])]
+
+        transfers = [self.submit(function, item) for item in items]
+
+        return [transfer.wait() for transfer in transfers]
+
+    def work(self):
+        self.local.in_worker = True
+
+        while True:
+            transfer, function, arguments = self.queue.get()
+            self.run(transfer, function, arguments)
+
+    def run(self, transfer, function, arguments):
+        try:
+            transfer.result = function(*arguments)
+        except Exception as error:
+            transfer.error = error
+
+        transfer.done.set()
@@ -0,0 +1,257 @@
+#
+# @file  writeback.py
+#
+# @brief Per file handle buffer of dirty blocks, written back to the driver on flush.
+#
+
+import tempfile
+
+from errno import EIO
+
+from fuse import FuseOSError
+
+import helpers.blocks
+
+
+#
+# Merge (start, end) into a sorted list of non-overlapping extents.
+def add_extent(extents, start, end):
+    merged = []
+
+    for extent_start, extent_end in extents:
+        if extent_end < start or extent_start > end:
+            merged.append((extent_start, extent_end))
+        else:
+            start = min(start, extent_start)
+            end = max(end, extent_end)
+
+    merged.append((start, end))
+
+    return sorted(merged)
+
+
+class DirtyBlock:
+    def __init__(self):
+        # Buffered bytes, zero filled wherever nothing has been written yet.
+        self.contents = bytearray()
+        # Byte ranges of contents that have actually been written.
+        self.extents = []
+        # Set once the block has been spilled out of memory: (slot, length) in the spill file.
+        self.spilled = None
+
+
+class WriteBuffer:
+    def __init__(self, block_size, memory_limit=64 * 1024 * 1024, spill_directory=None):
+        self.block_size = block_size
+        self.memory_limit = memory_limit
+        self.spill_directory = spill_directory
+
+        self.blocks = {}
+        self.memory_used = 0
+        # Highest offset written through this buffer, so getattr can report the size before a flush.
+        self.end = 0
+
+        self.spill_file = None
+        self.spill_slots = []
+        self.spill_slot_count = 0
+
+    def is_dirty(self, index=None):
+        if index is None:
+            return bool(self.blocks)
+
+        return index in self.blocks
+
+    def dirty_indexes(self):
+        return sorted(self.blocks)
+
+    #
+    # Return the written parts of the buffer as sorted, merged (start, end) file offsets.
+    def dirty_ranges(self):
+        ranges = []
+
+        for index in self.dirty_indexes():
+            block_start = (index - 1) * self.block_size
+
+            for extent_start, extent_end in self.blocks[index].extents:
+                start, end = block_start + extent_start, block_start + extent_end
+
+                if ranges and ranges[-1][1] >= start:
+                    ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+                else:
+                    ranges.append((start, end))
+
+        return ranges
+
+    #
+    # Return (file offset, bytes) for every buffered write overlapping bytes [offset, offset + size).
+    def extents_in_range(self, offset, size):
+        end = offset + size
+        extents = []
+
+        for index in range(offset // self.block_size + 1, (end - 1) // self.block_size + 2):
+            dirty_block = self.blocks.get(index)
+            if dirty_block is None:
+                continue
+
+            contents = self.load(dirty_block)
+            block_start = (index - 1) * self.block_size
+
+            for extent_start, extent_end in dirty_block.extents:
+                start = max(block_start + extent_start, offset)
+                stop = min(block_start + extent_end, end)
+
+                if start < stop:
+                    # Copied once, as the buffer may change as soon as the caller lets go of the file.
+                    extents.append((start, memoryview(contents)[start - block_start:stop - block_start].tobytes()))
+
+        return extents
+
+    #
+    # Absorb a write into the buffer. Nothing is read from or sent to the driver, and
+    # data is copied once, straight into the blocks it lands in.
+    def write(self, offset, data):
+        index = offset // self.block_size + 1
+        offset_for_block = offset % self.block_size
+
+        for data_block in helpers.blocks.string_to_chunks(data, self.block_size,
+                                                          self.block_size - offset_for_block):
+            dirty_block = self.blocks.get(index)
+            if dirty_block is None:
+                dirty_block = self.blocks[index] = DirtyBlock()
+
+            contents = self.load(dirty_block)
+            end = offset_for_block + len(data_block)
+
+            self.memory_used += max(end - len(contents), 0)
+
+            if len(contents) < offset_for_block:
+                contents.extend(bytearray(offset_for_block - len(contents)))
+
+            # Assigning past the end grows the block, without zero filling the part being written.
+            contents[offset_for_block:end] = data_block
+            dirty_block.extents = add_extent(dirty_block.extents, offset_for_block, end)
+
+            self.end = max(self.end, (index - 1) * self.block_size + end)
+
+            index += 1
+            offset_for_block = 0
+
+        self.spill()
+
+    #
+    # Return the full contents of a dirty block. The stored copy is only loaded,
+    # through load_block(), when the buffered writes do not already cover every
+    # byte of it - so sequential writes never download the block they replace. A stored
+    # block that cannot be loaded raises EIO and leaves the block as it was, rather than
+    # merging the writes onto zeros.
+    def merge(self, index, stored_size, load_block):
+        dirty_block = self.blocks[index]
+        contents = self.load(dirty_block)
+        size = max(stored_size, len(contents))
+
+        if dirty_block.extents != [(0, size)]:
+            stored_contents = b""
+
+            if stored_size:
+                stored_contents = load_block()
+                if stored_contents is False or stored_contents is None:
+                    raise FuseOSError(EIO)
+
+            stored_contents = bytearray(stored_contents)
+            if len(stored_contents) < size:
+                stored_contents.extend(bytearray(size - len(stored_contents)))
+
+            for start, end in dirty_block.extents:
+                stored_contents[start:end] = contents[start:end]
+
+            self.memory_used += len(stored_contents) - len(contents)
+            contents = dirty_block.contents = stored_contents
+            dirty_block.extents = [(0, size)]
+
+        return bytes(contents)
+
+    #
+    # Forget everything buffered past length, for a truncate.
+    def truncate(self, length):
+        for index in self.dirty_indexes():
+            block_start = (index - 1) * self.block_size
+
+            if block_start >= length:
+                self.discard(index)
+                continue
+
+            dirty_block = self.blocks[index]
+            contents = self.load(dirty_block)
+            block_length = length - block_start
+
+            if len(contents) > block_length:
+                self.memory_used -= len(contents) - block_length
+                del contents[block_length:]
+                dirty_block.extents = [(start, min(end, block_length))
+                                       for start, end in dirty_block.extents if start < block_length]
+
+        self.end = min(self.end, length)
+
+    def discard(self, index):
+        dirty_block = self.blocks.pop(index, None)
+
+        if dirty_block is None:
+            return
+
+        if dirty_block.spilled:
+            self.spill_slots.append(dirty_block.spilled[0])
+        else:
+            self.memory_used -= len(dirty_block.contents)
+
+    def close(self):
+        self.blocks = {}
+        self.memory_used = 0
+
+        if self.spill_file:
+            self.spill_file.close()
+            self.spill_file = None
+            self.spill_slots = []
+            self.spill_slot_count = 0
+
+    #
+    # Bring a spilled block back into memory and return its contents.
+    def load(self, dirty_block):
+        if dirty_block.spilled:
+            slot, length = dirty_block.spilled
+            self.spill_file.seek(slot * self.block_size)
+            dirty_block.contents = bytearray(self.spill_file.read(length))
+            dirty_block.spilled = None
+            self.spill_slots.append(slot)
+            self.memory_used += length
+
+        return dirty_block.contents
+
+    #
+    # Move dirty blocks out to a temporary file until the buffer fits in its memory limit.
+    def spill(self):
+        if self.memory_used <= self.memory_limit:
+            return
+
+        if not self.spill_file:
+            self.spill_file = tempfile.TemporaryFile(dir=self.spill_directory)
+
+        for index in self.dirty_indexes():
+            if self.memory_used <= self.memory_limit:
+                break
+
+            dirty_block = self.blocks[index]
+            if dirty_block.spilled:
+                continue
+
+            if self.spill_slots:
+                slot = self.spill_slots.pop()
+            else:
+                slot = self.spill_slot_count
+                self.spill_slot_count += 1
+
+            self.spill_file.seek(slot * self.block_size)
+            self.spill_file.write(dirty_block.contents)
+
+            dirty_block.spilled = (slot, len(dirty_block.contents))
+            self.memory_used -= len(dirty_block.contents)
+            dirty_block.contents = bytearray()
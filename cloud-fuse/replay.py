@@ -0,0 +1,284 @@
+#
+# @file  replay.py
+#
+# @brief Replays a trace recorded with --trace against a Context backed by any driver, at the
+#        original speed or faster, and reports the latency of every operation and the traffic
+#        it caused on the driver.
+#
+
+from __future__ import print_function, absolute_import, division
+
+import argparse
+import collections
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import drivers.filesystem
+import drivers.metered
+import drivers.scheduled
+import drivers.simulated
+import helpers.compression
+import helpers.dentry
+import helpers.metrics
+import helpers.trace
+
+from benchmark import cloud_fuse, make_context, make_data
+
+
+# Written data is not recorded, so writes are replayed with slices of this.
+PAYLOAD_SIZE = 1024 * 1024
+
+# Operations that only make sense on a file that already exists.
+FILE_OPERATIONS = ('open', 'read', 'write', 'truncate', 'release', 'flush', 'fsync', 'unlink')
+
+
+def make_driver(arguments):
+    if arguments.driver == 'filesystem':
+        return drivers.filesystem.FileSystem()
+
+    if arguments.driver == 'simulated':
+        return drivers.simulated.SimulatedDriver(rtt=arguments.rtt / 1000.0,
+                                                 bandwidth=arguments.bandwidth * 1024 * 1024 or None,
+                                                 jitter=arguments.jitter / 1000.0,
+                                                 error_rate=arguments.error_rate,
+                                                 seed=arguments.seed)
+
+    driver = importlib.import_module('drivers.dropbox_driver').DropboxDriver()
+    driver.init()
+    return driver
+
+
+def make_payload(offset, size):
+    payload = make_data(PAYLOAD_SIZE, 5)
+    start = offset % PAYLOAD_SIZE
+    data = payload[start:start + size]
+
+    while len(data) < size:
+        data += payload[:size - len(data)]
+
+    return data
+
+
+#
+# Work out what must already have existed when the trace was recorded: directories,
+# and files with the size that the operations on them need.
+# Returns (directories, path -> file size).
+def find_existing(records):
+    created = set()
+    directories = set()
+    files = {}
+
+    for record in records:
+        if record.error or not record.path or record.path == '/':
+            continue
+
+        parent = record.path.rsplit('/', 1)[0]
+        while parent:
+            directories.add(parent)
+            parent = parent.rsplit('/', 1)[0]
+
+        if record.op in ('create', 'mkdir'):
+            created.add(record.path)
+        elif record.path in created:
+            continue
+        elif record.op == 'readdir':
+            directories.add(record.path)
+        elif record.op in FILE_OPERATIONS or record.op == 'getattr':
+            files[record.path] = max(files.get(record.path, 0), record.offset + record.size)
+
+    directories -= created
+    directories.discard('/')
+
+    return directories, dict((path, size) for path, size in files.items() if path not in directories)
+
+
+def populate(context, directories, files):
+    for directory in sorted(directories, key=lambda path: path.count('/')):
+        context.mkdir(directory, 0o755)
+
+    for path, size in files.items():
+        fh = context.create(path, 0o644)
+        for offset in range(0, size, PAYLOAD_SIZE):
+            context.write(path, make_payload(offset, min(PAYLOAD_SIZE, size - offset)), offset, fh)
+        context.release(path, fh)
+
+
+#
+# Rebuild the arguments of a recorded operation, or return None if it cannot be replayed.
+def make_arguments(record, handles):
+    fh = handles.get(record.fh, 0)
+
+    if record.op == 'read':
+        return record.path, record.size, record.offset, fh
+    if record.op == 'write':
+        return record.path, make_payload(record.offset, record.size), record.offset, fh
+    if record.op == 'truncate':
+        return record.path, record.offset
+    if record.op == 'open':
+        return record.path, 0
+    if record.op == 'create':
+        return record.path, 0o644
+    if record.op == 'mkdir':
+        return record.path, 0o755
+    if record.op in ('release', 'flush', 'readdir'):
+        return record.path, fh
+    if record.op == 'fsync':
+        return record.path, 0, fh
+    if record.op in ('getattr', 'unlink', 'rmdir', 'statfs'):
+        return record.path,
+    if record.op == 'rename':
+        return record.path, record.target
+
+    return None
+
+
+#
+# Replay records against context, returning how long it took, the errors raised counted by
+# operation and exception type, and the operations that could not be replayed counted by operation.
+def replay(context, records, speed):
+    # Recorded file handle -> file handle returned by this replay.
+    handles = {}
+    errors = collections.Counter()
+    skipped = collections.Counter()
+    began = time.time()
+
+    for record in records:
+        if speed:
+            delay = began + record.start / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        arguments = make_arguments(record, handles)
+        if arguments is None:
+            skipped[record.op] += 1
+            continue
+
+        # A failing operation, whatever it raises, is counted rather than ending the replay.
+        try:
+            result = context(record.op, *arguments)
+        except Exception as error:
+            errors['{} {}'.format(record.op, type(error).__name__)] += 1
+            continue
+
+        if record.op in ('open', 'create'):
+            handles[record.fh] = result
+        elif record.op == 'release':
+            handles.pop(record.fh, None)
+
+    return time.time() - began, errors, skipped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a cloud-fuse trace.')
+    parser.add_argument('trace')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay this many times faster than recorded, 0 replays as fast as possible')
+    parser.add_argument('--driver', default='simulated', choices=['filesystem', 'simulated', 'dropbox'])
+    parser.add_argument('--rtt', type=float, default=50,
+                        help='simulated round trip time in milliseconds')
+    parser.add_argument('--jitter', type=float, default=10,
+                        help='up to this many milliseconds are added to each simulated round trip')
+    parser.add_argument('--bandwidth', type=float, default=10,
+                        help='simulated link bandwidth in MiB/s, 0 for unlimited')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--block-size', type=int, default=65534)
+    parser.add_argument('--transfers', type=int)
+    parser.add_argument('--readahead', type=int, default=32)
+    parser.add_argument('--cache-size', type=int, default=0, help='block cache budget in MiB')
+    parser.add_argument('--compression', default='raw', choices=helpers.compression.available_codecs())
+    parser.add_argument('--chunking', default='fixed', choices=['fixed', 'cdc'])
+    parser.add_argument('--output', help='file to write the report to, defaults to stdout')
+    arguments = parser.parse_args()
+
+    records = list(helpers.trace.read_trace(arguments.trace))
+
+    recorded = {}
+    for record in records:
+        recorded.setdefault(record.op, helpers.metrics.Histogram()).record(record.latency)
+
+    work_directory = tempfile.mkdtemp(prefix='cloud-fuse-replay-')
+    previous_directory = os.getcwd()
+    trace_path = os.path.abspath(arguments.trace)
+
+    # The filesystem prints on every operation, which is not what is being measured.
+    real_stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+
+    try:
+        os.chdir(work_directory)
+        os.makedirs('data12')
+
+        engine = cloud_fuse.open_database('sqlite:///nodes.db')
+        cloud_fuse.BlockSize = arguments.block_size
+
+        driver = make_driver(arguments)
+
+        # Files the trace expects to exist are written first, outside the simulated link.
+        directories, files = find_existing(records)
+        if isinstance(driver, drivers.simulated.SimulatedDriver):
+            cloud_fuse.filesystem = drivers.filesystem.FileSystem()
+        else:
+            cloud_fuse.filesystem = driver
+        populate(make_context(arguments, cloud_fuse.filesystem, 'setup-cache'), directories, files)
+        cloud_fuse.session.remove()
+        cloud_fuse.dentry_cache = helpers.dentry.DentryCache()
+
+        metrics = helpers.metrics.Metrics()
+        metrics.watch_engine(engine)
+        cloud_fuse.filesystem = drivers.scheduled.ScheduledDriver(drivers.metered.MeteredDriver(driver, metrics),
+                                                                  metrics=metrics)
+        context = make_context(arguments, cloud_fuse.filesystem, 'block-cache', metrics)
+
+        seconds, errors, skipped = replay(context, records, arguments.speed)
+        cloud_fuse.session.remove()
+    finally:
+        sys.stdout.close()
+        sys.stdout = real_stdout
+        os.chdir(previous_directory)
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    stats = metrics.snapshot()
+    traffic = dict(calls=0, errors=0, bytes_sent=0, bytes_received=0)
+
+    for call, call_stats in stats['drivers'].get(cloud_fuse.filesystem.name, {}).items():
+        traffic['calls'] += call_stats['calls']
+        traffic['errors'] += call_stats['errors']
+        if call == 'write_file':
+            traffic['bytes_sent'] += call_stats['bytes']
+        else:
+            traffic['bytes_received'] += call_stats['bytes']
+
+    report = dict(
+        trace=dict(
+            path=trace_path,
+            operations=len(records),
+            seconds=records[-1].start + records[-1].latency if records else 0,
+            latency=dict((op, histogram.snapshot()) for op, histogram in recorded.items()),
+            existing_directories=len(directories),
+            existing_files=len(files)
+        ),
+        replay=dict(
+            seconds=seconds,
+            speed=arguments.speed,
+            errors=dict(errors),
+            skipped=dict(skipped),
+            latency=stats['operations'],
+            queries=stats['queries']
+        ),
+        traffic=traffic,
+        drivers=stats['drivers'],
+        settings=dict((key, value) for key, value in vars(arguments).items() if key != 'output')
+    )
+
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()